@@ -4,7 +4,7 @@ App made by:
 Contact:
     eduardo_reyes09@hotmail.com
 
-DepMap release used: 
+DepMap releases used (see RELEASES in depmap_data.py): 
     23Q4
 
 Data source:
@@ -23,105 +23,92 @@ App version:
 
 # Import the required libraries
 
-import os
 import time
 from typing import List
-import requests
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import streamlit as st
 from streamlit_searchbox import st_searchbox
-from io import BytesIO
+
+import depmap_data
 
 ###################################################################################################
 
-# Cached function to download and/or read the required files just once
+# Cached function to get the registry of DepMap releases, created once per server process
+# The registry loads each release on first use and keeps the most recently used ones, as read-only 
+# datasets shared by all sessions (st.cache_data would give each session its own copy). Sessions only
+# keep their selections and the small data extracted from them.
+# The objects derived from a dataset below (indexes, summaries...) are cached with the same limit of 
+# releases (times the options of each one), so they do not keep releases in memory after they are dropped.
+# The default release starts loading in the background as soon as the registry is created (the first 
+# run of the script in the server process), and every session arriving meanwhile follows that load.
+
+@st.cache_resource(show_spinner=False)
+def get_release_registry():
+    release_registry = depmap_data.ReleaseRegistry()
+    release_registry.start_loading(depmap_data.DEFAULT_RELEASE)
+    return release_registry
 
-@st.cache_data(show_spinner=False)
-def get_files():
-    # Show a status bar indicating when each step is completed
-    with st.status("Loading...", expanded=False) as status:
-        
-        # Defined file names to be used in this script
-        rna_file = "DepMap_RNASeq_23Q4.csv"
-        cell_info_file = "DepMap_CellInfo_23Q4.csv"
-
-        # URLs for the files to download
-        directory1 = "https://plus.figshare.com/ndownloader/files/43347204"
-        directory2 = "https://plus.figshare.com/ndownloader/files/43746708"
-
-        # Check if files exist in the working directory, otherwise download them
-        if not (os.path.isfile(rna_file) and os.path.isfile(cell_info_file)):
-            
-            status.update(label="Downloading files...")
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
-                'Referer': 'https://plus.figshare.com'
-            }
-
-            def download_file(url, local_filename):
-                retries = 3
-                for attempt in range(retries):
-                    try:
-                        response = requests.get(url, headers=headers)
-                        response.raise_for_status()  # Raise HTTPError for bad responses (4xx and 5xx)
-                        with open(local_filename, 'wb') as f:
-                            f.write(response.content)
-                        return True
-                    except requests.exceptions.RequestException as e:
-                        st.error(f'Error on attempt {attempt + 1}: {e}')
-                        if attempt < retries - 1:
-                            time.sleep(2 ** attempt)
-                        else:
-                            return False
-
-            if download_file(directory1, rna_file) and download_file(directory2, cell_info_file):
-                status.update(label="Files downloaded!")
+###################
+
+# Function to show the progress of the background load of a release until it is ready
+# Each stage completed is listed in the status widget, and the last one is shown as its label
+def wait_for_release(release, status):
+
+    release_registry = get_release_registry()
+    release_registry.start_loading(release)
+    stage_list = st.empty()
+    while True:
+        ready, stages, error = release_registry.loading_status(release)
+        if error is not None:
+            status.update(label="Loading failed", state="error", expanded=True)
+            if isinstance(error, depmap_data.DownloadError):
+                st.error(f"Failed to download files after multiple attempts. {error}")
             else:
-                st.error("Failed to download files after multiple attempts.")
-                st.stop()
-        else:
-            status.update(label="Files found!")
+                st.error(f"Failed to prepare the files. {error}")
+            st.stop()
+        if stages:
+            status.update(label=stages[-1])
+            stage_list.markdown("\n".join(f"- {stage}" for stage in stages))
+        if ready:
+            break
+        time.sleep(0.5)
+    status.update(label="Ready to begin search!", state="complete", expanded=False)
 
-        # Import the csv files into dataframes
-        status.update(label="Importing files...")
-        RNA_expression = pd.read_csv(rna_file)
-        sample_IDs = pd.read_csv(cell_info_file)
-        
-        # Sort the IDs by cell line name and get the relevant columns  
-        status.update(label="Pre-processing files...")
-        sample_IDs = sample_IDs.sort_values(by=["CellLineName"])
-        sample_IDs = sample_IDs[sample_IDs["CellLineName"].notna()]
-        sample_IDs = sample_IDs.reset_index(drop=True)
-        cell_menu = sample_IDs[["ModelID", "CellLineName", "OncotreeLineage", "OncotreePrimaryDisease"]]
-        cell_menu.columns = ["Achilles ID", "Cell line", "Tissue", "Disease"]
-
-        # The first column of the RNASeq dataset has no name, and we need it transposed
-        RNA_expression = RNA_expression.set_index("Unnamed: 0").T
-        RNA_expression["Gene"] = RNA_expression.index
-        RNA_expression["Gene"] = RNA_expression["Gene"].str.replace(r'\s\(\d+\)$', '', regex=True)
-        RNA_expression = RNA_expression.reset_index(drop=True)
-        RNA_expression = RNA_expression.set_index("Gene")
-
-        # Create a dictionary to map "Achilles ID" to "Cell line" and replace the IDs for names in RNA_expression
-        id_to_cell_line = dict(zip(cell_menu["Achilles ID"], cell_menu["Cell line"]))
-        column_names_to_replace = RNA_expression.columns
-        new_column_names = []
-        for col in column_names_to_replace:
-            new_name = id_to_cell_line.get(col, col)
-            new_column_names.append(new_name)
-        RNA_expression.columns = new_column_names
-        RNA_expression = RNA_expression.sort_index(axis=1)
-        RNA_expression = RNA_expression.sort_index()
-
-        # Since not all the cell lines in the DepMap/Achilles project have RNA Seq data, remove those from both menus
-        cell_menu = cell_menu[cell_menu["Cell line"].isin(RNA_expression.columns)]
-        cell_menu_tissues = [""] + list(cell_menu["Tissue"].dropna().unique())
-        cell_menu_tissues.sort()
-
-        status.update(label="Ready to begin search!", state="complete", expanded=False)
-        
-    return RNA_expression, cell_menu, cell_menu_tissues
+###################
+
+# Function to get the dataset of a release (it is already loaded, unless it was dropped from the registry)
+def get_files(release):
+
+    try:
+        return get_release_registry().get(release)
+    except depmap_data.DownloadError as e:
+        st.error(f"Failed to download files after multiple attempts. {e}")
+        st.stop()
+
+###################
+
+# Function to clear the selections and results of a session (they may not exist in another release)
+def reset_session():
+    st.session_state["keep_cells_previous"] = []
+    st.session_state["keep_cells_current"] = []
+    st.session_state["search_string_temporal"] = ""
+    st.session_state["search_results_interactive"] = pd.DataFrame()
+    st.session_state["checked_genes"] = set()
+    st.session_state["gene_table_version"] = 0
+    for key in ["keep_cells_final", "extracted_RNA_data", "export_data", "plot_data", "plot_data_genes",
+                "saved_cells", "group_comparison", "gene_set_scores", "gene_page"]:
+        st.session_state.pop(key, None)
+
+###################
+
+# Callback of the release picker, the new release is prepared on the next run
+def change_release():
+    st.session_state["release"] = st.session_state["release_picker"]
+    st.session_state["release_ready"] = False
+    reset_session()
 
 ###################################################################################################
 
@@ -135,46 +122,49 @@ st.set_page_config(
         'Get Help': "https://github.com/EdRey05/Streamlit_projects/tree/main/001_RNA_expression_DepMap",
         'Report a bug': "mailto:eduardo_reyes09@hotmail.com"})
 
-# Check if the data has already been loaded, otherwise download and import it
-if "cell_menu" not in st.session_state or st.session_state["cell_menu"] is None:
+# Initialize variables in the session state to enable full widget interactivity (new sessions only)
+if "release" not in st.session_state:
+    st.session_state["release"] = depmap_data.DEFAULT_RELEASE
+    st.session_state["release_ready"] = False
+    reset_session()
+release = st.session_state["release"]
+
+# Sessions arriving after the release was loaded (by the background load or another session) skip the banner
+if not st.session_state["release_ready"] and get_release_registry().loading_status(release)[0]:
+    st.session_state["release_ready"] = True
+
+# Check if the release used by this session is ready, otherwise wait for its download and import
+if not st.session_state["release_ready"]:
     
-    message = st.markdown('''
+    message = st.markdown(f'''
         <div style='background-color: #0E6655; padding: 10px; border-radius: 5px; text-align: center; width: 75%; margin: auto;'>
             <p style='font-size: 20px; font-weight: bold;'>THE FILES ARE BEING PREPARED... The app will launch shortly</p>
-            <p>This app was tailored for the RNA Seq dataset from the DepMap portal, release 23Q4.</p>
+            <p>This app was tailored for the RNA Seq dataset from the DepMap portal, release {release}.</p>
             <p>The file used was OmicsExpressionProteinCodingGenesTPMLogp1.csv and gives values in log2(TPM+1) units.</p>
-            <p>For more information on the 23Q4 data or newer releases, consult: <a href="https://depmap.org/portal/download/all/" target="_blank">DepMap Portal</a>.</p>
+            <p>For more information on the {release} data or newer releases, consult: <a href="https://depmap.org/portal/download/all/" target="_blank">DepMap Portal</a>.</p>
             <p>Tutorial: <a href="https://github.com/EdRey05/Streamlit_projects/tree/main/001_RNA_expression_DepMap" target="_blank">Instructions and Demo</a> </p>
         </div>
         ''', unsafe_allow_html=True)
     a = st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True) 
 
-    # Start downloading or importing the files
-    RNA_expression, cell_menu, cell_menu_tissues = get_files()
-
-    # Save heavy data variables to session state so get_files only runs one time
-    st.session_state["RNA_expression"] = RNA_expression
-    st.session_state["cell_menu"] = cell_menu
-    st.session_state["cell_menu_tissues"] = cell_menu_tissues
-
-    # Initialize variables in the session state to enable full widget interactivity
-    st.session_state["keep_cells_previous"] = []
-    st.session_state["keep_cells_current"] = []
-    st.session_state["search_string_temporal"] = ""
-    st.session_state["search_results_interactive"] = pd.DataFrame()
-    st.session_state["df_to_plot"] = pd.DataFrame()
-    st.session_state["displayed_df_to_plot"] = pd.DataFrame()
+    # Follow the download or import of the files (started by the first session), showing each step completed
+    with st.status("Loading...", expanded=True) as status:
+        wait_for_release(release, status)
+    st.session_state["release_ready"] = True
 
     # Clear the initial message
     message.empty()
     a.empty()
     st.rerun()
 
+# Get the shared dataset (the same objects for all sessions, nothing is copied to the session state)
+RNA_expression, cell_menu = get_files(release)
+
 ###################################################################################################
 
 # Step 2 - Create app layout
 
-st.title("Retrieve RNASeq data from the DepMap portal (23Q4)")
+st.title(f"Retrieve RNASeq data from the DepMap portal ({release})")
 st.markdown('<hr style="margin-top: +5px; margin-bottom: +5px;">', unsafe_allow_html=True)
 col_1_row_1, col_2_row_1 = st.columns([2, 3], gap="medium")
 st.markdown('<hr style="margin-top: +10px; margin-bottom: +15px;">', unsafe_allow_html=True)
@@ -186,29 +176,54 @@ col_1_row_3, col_2_row_3 = st.columns(2, gap="medium")
 
 # Step 3 - Create the main widgets in column 1-row 1, and one more in the same row upon interaction
 
+# Cached function to build the lookup tables of the cell menu just once per dataset (shared by all sessions)
+@st.cache_resource(show_spinner=False, max_entries=depmap_data.MAX_LOADED_RELEASES)
+def get_cell_menu_index(_cell_menu, source_hash):
+    return depmap_data.CellMenuIndex(_cell_menu)
+
+###################
+
+# Cached function to build the similarity index of the cell line profiles just once per dataset and gene
+# choice (all genes or the most variable ones), shared by all sessions
+@st.cache_resource(show_spinner=False, max_entries=2 * depmap_data.MAX_LOADED_RELEASES)
+def get_similarity_index(_expression_store, source_hash, variable_genes):
+    return depmap_data.SimilarityIndex(_expression_store, depmap_data.VARIABLE_GENES if variable_genes else None)
+
+###################
+
 # The widgets on the first row are created immediately after loading the files
 with col_1_row_1:
     
-    # Buttons for the two types of cell line search available
-    st.radio(key="search_by", label="Search cell lines by:", options=["Name", "Tissue type"])
+    # Menu to change the DepMap release used (this clears the current selections)
+    st.selectbox(key="release_picker", label="DepMap release:", options=list(depmap_data.RELEASES), 
+                 index=list(depmap_data.RELEASES).index(release), on_change=change_release)
+
+    # Buttons for the three types of cell line search available
+    st.radio(key="search_by", label="Search cell lines by:", options=["Name", "Tissue type", "Similar profile"])
     st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
 
     # This responds to the radio button and displays a different widget depending on the type of search chosen
+    # The results df comes from the cell menu index (precomputed per tissue and cached by name), not copied
+    cell_menu_index = get_cell_menu_index(cell_menu, RNA_expression.source_hash)
     if st.session_state["search_by"] == "Name":
         st.text_input(key="search_string", label="Type the name of the cell line or part of it", value="")
-
-        # Generate the results df
-        search_results = st.session_state["cell_menu"].copy()
-        search_results["Keep cell line?"] = False
-        search_results = search_results[search_results["Cell line"].str.contains(st.session_state["search_string"], case=False, na=False)]
+        search_results = cell_menu_index.search_name(st.session_state["search_string"])
 
     elif st.session_state["search_by"] == "Tissue type":
-        st.selectbox(key="search_string", label="Select a tissue", options=st.session_state["cell_menu_tissues"], index=0)
-        
-        # Generate the results df
-        search_results = st.session_state["cell_menu"].copy()
-        search_results["Keep cell line?"] = False
-        search_results = search_results[search_results["Tissue"] == st.session_state["search_string"]]
+        st.selectbox(key="search_string", label="Select a tissue", options=cell_menu_index.tissues, index=0)
+        search_results = cell_menu_index.search_tissue(st.session_state["search_string"])
+
+    # The results are the cell lines with the most similar expression profiles (a new list of results 
+    # when the genes compared change, so the previous checks are not carried over)
+    elif st.session_state["search_by"] == "Similar profile":
+        st.selectbox(key="search_string", label="Select a cell line to find the most similar ones", 
+                     options=[""] + cell_menu["Cell line"].tolist(), index=0)
+        st.toggle(key="variable_genes", label=f"Compare only the {depmap_data.VARIABLE_GENES} most variable genes",
+                  on_change=lambda: st.session_state.update(keep_cells_previous=[]))
+        if st.session_state["search_string"]:
+            with st.spinner("Comparing the cell line profiles (only the first time)..."):
+                similarity_index = get_similarity_index(RNA_expression, RNA_expression.source_hash, st.session_state["variable_genes"])
+            search_results = cell_menu_index.search_similar(st.session_state["search_string"], similarity_index)
     
     st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
 
@@ -270,19 +285,7 @@ with col_1_row_1:
 
 # Step 4 - Extract selected cell lines from the RNA dataset and prepare to preview and download when the user decides to
 
-# Function to save the extracted dataframe to Excel
-def save_to_excel(dataframe, filename='RNA_Results.xlsx'):
-
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        dataframe.to_excel(writer, index=True, sheet_name='Search_01')
-    output.seek(0)
-
-    return output
-
-###################
-
-# Button to trigger excel file preparation with the function above
+# Button to extract the selected cell lines and show the preview
 with col_3_row_2:
     preview_button = st.button(label="Preview results", type="primary")
 
@@ -292,71 +295,132 @@ if preview_button and st.session_state["keep_cells_final"]:
     col_2_row_3.empty()
     col_1_row_3.empty()
 
-    # Find the current cummulative selections in the pre-processed RNA df
-    st.session_state["extracted_RNA_data"] = st.session_state["RNA_expression"].loc[:, st.session_state["keep_cells_final"]]
+    # Find the current cummulative selections in the pre-processed RNA df (each stage is timed and logged)
+    timer = depmap_data.StageTimer("preview results", depmap_data.TIMING_LOG)
+    st.session_state["extracted_RNA_data"] = RNA_expression.extract(st.session_state["keep_cells_final"])
     st.session_state["extracted_RNA_data"] = st.session_state["extracted_RNA_data"].reset_index(drop=False)
+    timer.lap("Extract cell lines")
 
-    # Prepare the data for preliminary plots
-    st.session_state["gene_list"] = tuple(st.session_state["extracted_RNA_data"]["Gene"].tolist()) 
-    st.session_state["df_to_plot"] = st.session_state["extracted_RNA_data"].copy()   
-    st.session_state["df_to_plot"].insert(0, "Plot?", False)
+    # Start the preliminary plots with no genes checked, on the first page of the genes table
+    st.session_state["checked_genes"] = set()
+    st.session_state["gene_table_version"] += 1
+    timer.lap("Prepare results table")
     
-    # Call the function to convert the results df to a xlsx file
-    st.session_state["excel_data"] = save_to_excel(st.session_state["extracted_RNA_data"])
+    # A file prepared (or genes filtered to plot) for previous results should not be used anymore
+    for key in ["export_data", "plot_data", "plot_data_genes", "gene_page"]:
+        st.session_state.pop(key, None)
+    st.toast(f"Results of {len(st.session_state['keep_cells_final'])} cell lines ready in {timer.total_seconds() * 1000:.0f} ms")
 
-# Display a button to download the results when a file has been made 
-if "excel_data" in st.session_state:
+# The file to download is only made when the user asks for it, in the format chosen
+if "extracted_RNA_data" in st.session_state:
     with col_4_row_2:
-        st.download_button(label="Download dataset", data=st.session_state["excel_data"], file_name='RNA_Results.xlsx', type="primary")
+        st.selectbox(key="export_format", label="File format", options=list(depmap_data.EXPORT_FORMATS), 
+                     label_visibility="collapsed")
+        prepare_button = st.button(label="Prepare download")
+
+    if prepare_button:
+        with col_5_row_2:
+            with st.spinner("Preparing file..."):
+                timer = depmap_data.StageTimer("prepare download", depmap_data.TIMING_LOG)
+                file_format = depmap_data.EXPORT_FORMATS[st.session_state["export_format"]]
+                st.session_state["export_data"] = depmap_data.export_frame(st.session_state["extracted_RNA_data"], file_format)
+                st.session_state["export_file_name"] = f"RNA_Results.{file_format}"
+                timer.lap(f"Write {file_format} file")
+
+# Display a button to download the results when a file has been made 
+if "export_data" in st.session_state:
+    with col_5_row_2:
+        st.download_button(label=f"Download {st.session_state['export_file_name']}", data=st.session_state["export_data"], 
+                           file_name=st.session_state["export_file_name"], type="primary")
 
 ###################################################################################################
 
 # Step 5 - Show a preview of the results df and a tool to plot gene expression
 
+# Cached function to build the index of gene names just once per dataset (shared by all sessions)
+@st.cache_resource(show_spinner=False, max_entries=depmap_data.MAX_LOADED_RELEASES)
+def get_gene_index(_expression_store, source_hash):
+    return depmap_data.GeneIndex(_expression_store.genes)
+
+###################
+
 # Function to search through the genes for the preliminary plots
 def search_genes(searchterm: str) -> List[tuple[str, str]]:
     
-    # Assuming st.session_state["gene_list"] is a list of gene names
-    suggestions = [gene for gene in st.session_state["gene_list"] if searchterm.lower() in gene.lower()]
+    # Get the best matches from the gene index (exact, then starting with, then containing the term)
+    suggestions = get_gene_index(RNA_expression, RNA_expression.source_hash).search(searchterm)
     
     # Returning a list of tuples where each tuple contains a label and a value
     return [(gene, gene) for gene in suggestions]
 
 ###################
 
+# Function to get the expression of the genes to plot (genes as rows), only filtered again when the 
+# checked genes change, so the reruns made by other widgets reuse it
+def get_plot_data(plot_genes):
+
+    if st.session_state.get("plot_data_genes") != plot_genes:
+        extracted_RNA_data = st.session_state["extracted_RNA_data"]
+        st.session_state["plot_data"] = extracted_RNA_data[extracted_RNA_data["Gene"].isin(plot_genes)].set_index("Gene")
+        st.session_state["plot_data_genes"] = plot_genes
+
+    return st.session_state["plot_data"]
+
+###################
+
 # Function to make plots based on genes selected by the searchbox and/or data editor 
 def gene_plotter():
     
-    # Get any genes currently selected in the data editor
-    plot_genes = st.session_state["displayed_df_to_plot"].loc[st.session_state["displayed_df_to_plot"]["Plot?"], "Gene"].tolist()
+    # Get the genes currently checked (through the searchbox or the gene tables)
+    plot_genes = sorted(st.session_state["checked_genes"])
     
     if plot_genes:
         # Plot the genes of interest and allow to swap the grouping type
         with col_2_row_3:
             st.radio(key="plot_type", label="Plot type", options=["Bar chart", "Heatmap"])
             st.toggle(key="group_by", label="Swap group by")
+            if st.session_state["plot_type"] == "Heatmap":
+                st.toggle(key="order_genes", label="Put genes with similar profiles together")
             st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
 
-            # Make one of two possible bar charts
+            start = time.perf_counter()
+            plot_data = get_plot_data(plot_genes)
+
+            # Make one of two possible bar charts (only for the first genes, a bar per value is too much to draw)
             if st.session_state["plot_type"] == "Bar chart":
+                if len(plot_data) > depmap_data.PLOT_MAX_BAR_GENES:
+                    st.warning(f"Only the first {depmap_data.PLOT_MAX_BAR_GENES} of {len(plot_data)} genes are shown as bars, "
+                               "use the heatmap to see all of them.")
+                    plot_data = plot_data.iloc[:depmap_data.PLOT_MAX_BAR_GENES]
+
                 if st.session_state["group_by"]:
-                    fig = px.bar(st.session_state["extracted_RNA_data"][st.session_state["extracted_RNA_data"]['Gene'].isin(plot_genes)], 
-                            x='Gene', y=st.session_state["extracted_RNA_data"].columns[1:], barmode='group',
+                    fig = px.bar(plot_data.reset_index(), x='Gene', y=plot_data.columns, barmode='group',
                             color_discrete_sequence=px.colors.qualitative.Dark2)
 
                     # Customize the appearance of the bars
                     fig.update_traces(marker=dict(line=dict(color='black', width=0.5)), selector=dict(type='bar'))
                     fig.update_layout(xaxis_title="Gene", yaxis_title="log2(TPM+1)", legend_title="Cell Line", font=dict(size=24))
                 else:
-                    fig = px.bar(st.session_state["extracted_RNA_data"][st.session_state["extracted_RNA_data"]['Gene'].isin(plot_genes)].set_index('Gene').T, 
-                                barmode='group', color_discrete_sequence=px.colors.qualitative.G10)
+                    fig = px.bar(plot_data.T, barmode='group', color_discrete_sequence=px.colors.qualitative.G10)
 
                     # Customize the appearance of the bars
                     fig.update_traces(marker=dict(line=dict(color='black', width=0.5)), selector=dict(type='bar'))
                     fig.update_layout(xaxis_title="Cell Line", yaxis_title="log2(TPM+1)", legend_title="Gene", font=dict(size=24))
             else:
-                # Make a heatmap
-                heatmap_data = st.session_state["extracted_RNA_data"][st.session_state["extracted_RNA_data"]['Gene'].isin(plot_genes)].set_index('Gene').T
+                # Order the genes by similarity if requested, then average groups of cell lines and genes if there
+                # are more than the heatmap can show (the browser would get a value per gene and cell line otherwise)
+                values, genes = plot_data.to_numpy(dtype=float), plot_data.index.tolist()
+                if st.session_state["order_genes"]:
+                    order = depmap_data.order_rows(values)
+                    values, genes = values[order], [genes[i] for i in order]
+                values, cells = depmap_data.aggregate_rows(values.T, plot_data.columns.tolist(), depmap_data.PLOT_MAX_HEATMAP_COLUMNS)
+                max_rows = min(depmap_data.PLOT_MAX_HEATMAP_ROWS, max(1, depmap_data.PLOT_MAX_HEATMAP_VALUES // len(cells)))
+                values, genes = depmap_data.aggregate_rows(values.T, genes, max_rows)
+                if len(cells) < len(plot_data.columns):
+                    st.info(f"The {len(plot_data.columns)} cell lines are shown as {len(cells)} columns, each one with the mean of consecutive cell lines.")
+                if len(genes) < len(plot_data):
+                    st.info(f"The {len(plot_data)} genes are shown as {len(genes)} rows, each one with the mean of consecutive genes.")
+                heatmap_data = pd.DataFrame(values, index=genes, columns=cells).T
 
                 # Switch rows and columns based on the toggle state
                 if st.session_state["group_by"]:
@@ -368,38 +432,344 @@ def gene_plotter():
                                 yaxis_title="Gene" if st.session_state["group_by"] else "Cell Line", 
                                 font=dict(size=24))
 
-            # Display plot
+            # Display plot, with the time taken to make it and the number of values sent to the browser
             fig.update_layout(height=400, width=600)
+            values_sent = plot_data.size if st.session_state["plot_type"] == "Bar chart" else heatmap_data.size
+            build_time = time.perf_counter() - start
             st.plotly_chart(fig)
+            st.caption(f"Plot made in {build_time * 1000:.0f} ms, {values_sent} values sent to the browser.")
     else:
         # Clear plots if no genes are currently selected
         col_2_row_3.empty()
 
 ###################
 
+# Function to get the rows of the genes table to show, with the "Plot?" column from the checked genes
+# The genes of the extracted data are sorted, so the rows of the checked genes are found by binary search
+def gene_table_rows(positions):
+    extracted_RNA_data = st.session_state["extracted_RNA_data"]
+    rows = extracted_RNA_data.iloc[positions]
+    plot_column = pd.DataFrame({"Plot?": rows["Gene"].isin(st.session_state["checked_genes"])}, index=rows.index)
+    return pd.concat([plot_column, rows], axis=1)
+
+def checked_gene_positions():
+    genes = st.session_state["extracted_RNA_data"]["Gene"].to_numpy()
+    checked_genes = sorted(st.session_state["checked_genes"])
+    starts, ends = np.searchsorted(genes, checked_genes, side="left"), np.searchsorted(genes, checked_genes, side="right")
+    return np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.array([], dtype=int)])
+
+###################
+
+# Function to update the checked genes from the boxes changed in a gene table (only its rows are compared)
+# The tables are made again with a new key afterwards, so they never keep edits made on other rows
+def update_checked_genes(shown_rows, edited_rows):
+    changed = edited_rows["Plot?"].to_numpy() != shown_rows["Plot?"].to_numpy()
+    if changed.any():
+        for gene, checked in zip(edited_rows.loc[changed, "Gene"], edited_rows.loc[changed, "Plot?"]):
+            if checked:
+                st.session_state["checked_genes"].add(gene)
+            else:
+                st.session_state["checked_genes"].discard(gene)
+        st.session_state["gene_table_version"] += 1
+        st.rerun()
+
+###################
+
 # Proceed with results visualization only when the data has been extracted
-if not st.session_state["df_to_plot"].empty:
+# Only the checked genes and one page of the genes are sent to the browser, never the whole table
+if "extracted_RNA_data" in st.session_state:
     
-    # Show a searchbox to quickly find genes as the df has thousands of rows (the user can scroll and check boxes too)
+    # Show a searchbox to quickly find genes as the df has thousands of rows (the user can browse the pages and check boxes too)
     with col_1_row_3:
         st_searchbox(key="selected_gene", search_function=search_genes, default=None, 
                     label="Type a gene name here or check/uncheck boxes below", clear_on_submit=True,)
         st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
     
-    # When the user selects a gene name, automatically check it to display it at the top of the df
+    # When the user selects a gene name, automatically check it to display it in the checked genes table
     if st.session_state["selected_gene"].get("result"):
-        selected_gene_result = st.session_state["selected_gene"].get("result")
-        st.session_state["df_to_plot"].loc[st.session_state["df_to_plot"]["Gene"] == selected_gene_result, "Plot?"] = True
+        st.session_state["checked_genes"].add(st.session_state["selected_gene"].get("result"))
+        st.session_state["gene_table_version"] += 1
         
         # Reset the searchbox so we dont keep the previous result when the df changes
         st.session_state["selected_gene"] = {"result": None, "search": "", "options_js": [], "key_react": "A"}
 
-    # Show the results df
-    st.session_state["sorted_df"] = st.session_state["df_to_plot"].sort_values(by=["Plot?", "Gene"], ascending=[False, True])
+    # Only the "Plot?" column can be edited in the gene tables
+    n_genes = len(st.session_state["extracted_RNA_data"])
+    fixed_columns = st.session_state["extracted_RNA_data"].columns.tolist()
+    version = st.session_state["gene_table_version"]
     with col_1_row_3:
-        st.session_state["displayed_df_to_plot"] = st.data_editor(data=st.session_state["sorted_df"], use_container_width=True, hide_index=True)
+
+        # Show the checked genes first (uncheck them here to remove them from the plots)
+        if st.session_state["checked_genes"]:
+            st.caption(f"Checked genes: {len(st.session_state['checked_genes'])}")
+            shown_checked = gene_table_rows(checked_gene_positions())
+            edited_checked = st.data_editor(data=shown_checked, key=f"checked_genes_table_{version}", disabled=fixed_columns,
+                                            use_container_width=True, hide_index=True)
+            update_checked_genes(shown_checked, edited_checked)
+
+        # Then show one page of all the genes (in alphabetical order)
+        col_1_page, col_2_page = st.columns(2)
+        page_size = col_1_page.selectbox(key="gene_page_size", label="Genes per page", options=depmap_data.GENE_TABLE_PAGE_SIZES)
+        n_pages = max(1, -(-n_genes // page_size))
+        # The page is set only through the session state (starting at 1), so it stays within the pages
+        st.session_state["gene_page"] = min(st.session_state.get("gene_page", 1), n_pages)
+        page = col_2_page.number_input(key="gene_page", label=f"Page (of {n_pages})", min_value=1, max_value=n_pages)
+        page_start, page_end = (page - 1) * page_size, min(page * page_size, n_genes)
+        shown_page = gene_table_rows(np.arange(page_start, page_end))
+        edited_page = st.data_editor(data=shown_page, key=f"gene_page_table_{version}_{page}_{page_size}", disabled=fixed_columns,
+                                     use_container_width=True, hide_index=True)
+        st.caption(f"Genes {page_start + 1}-{page_end} of {n_genes}")
+        update_checked_genes(shown_page, edited_page)
     
     # Call the function to plot the selected genes (if any)
     gene_plotter()
     
 ###################################################################################################
+
+# Step 6 - Additional tools working on the whole dataset (shared by all sessions)
+
+st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
+tab_map, tab_tissues, tab_coexpression, tab_groups, tab_gene_sets, tab_releases = st.tabs(
+    ["Cell line map", "Tissue overview", "Co-expression", "Compare groups", "Gene set scores", "Compare releases"])
+
+# Cached function to get the 2-D map of the cell lines, computed once per dataset and saved with it
+@st.cache_resource(show_spinner=False, max_entries=depmap_data.MAX_LOADED_RELEASES)
+def get_cell_line_map(_expression_store, _cell_menu, source_hash):
+    embedding = depmap_data.load_embedding(_expression_store)
+    cell_line_map = pd.DataFrame({"Cell line": _expression_store.cells, "PC1": embedding[:, 0], "PC2": embedding[:, 1]})
+    cell_info = _cell_menu.drop_duplicates("Cell line").set_index("Cell line")[["Tissue", "Disease"]]
+    return cell_line_map.join(cell_info, on="Cell line").fillna({"Tissue": "Unknown", "Disease": "Unknown"})
+
+# Show all the cell lines on the map of their expression profiles, with the current selections highlighted
+with tab_map:
+    st.radio(key="map_color", label="Color by:", options=["Tissue", "Disease"], horizontal=True)
+    with st.spinner("Computing the map of the cell lines (only the first time)..."):
+        cell_line_map = get_cell_line_map(RNA_expression, cell_menu, RNA_expression.source_hash)
+    fig = px.scatter(cell_line_map, x="PC1", y="PC2", color=st.session_state["map_color"], hover_name="Cell line",
+                     hover_data=["Tissue", "Disease"], render_mode="webgl", height=600)
+    selected = cell_line_map[cell_line_map["Cell line"].isin(st.session_state["keep_cells_current"])]
+    fig.add_trace(go.Scattergl(x=selected["PC1"], y=selected["PC2"], text=selected["Cell line"], mode="markers", 
+                               name="Your selections", hoverinfo="text",
+                               marker=dict(size=14, color="rgba(0,0,0,0)", line=dict(color="black", width=2))))
+    st.plotly_chart(fig, use_container_width=True)
+    st.caption("First two principal components of the expression profiles (randomized SVD). Hover over the points to see "
+               "the cell lines close to your selections, and search them by name to add them.")
+
+###################
+
+# Cached function to open the summaries precomputed per lineage or disease (shared by all sessions)
+@st.cache_resource(show_spinner=False, max_entries=len(depmap_data.SUMMARY_GROUPINGS) * depmap_data.MAX_LOADED_RELEASES)
+def get_group_summaries(_expression_store, source_hash, grouping):
+    return depmap_data.GroupSummaries(_expression_store.folder, grouping)
+
+# Show the expression of one gene across all lineages or diseases, from the precomputed summaries
+with tab_tissues:
+    col_1_tab_tissues, col_2_tab_tissues = st.columns([1, 2])
+    with col_1_tab_tissues:
+        st.text_input(key="overview_gene", label="Gene:")
+        st.radio(key="overview_grouping", label="Group cell lines by:", options=["Lineage", "Disease"], horizontal=True)
+    if st.session_state["overview_gene"]:
+        grouping = st.session_state["overview_grouping"].lower()
+        start = time.perf_counter()
+        try:
+            summary = get_group_summaries(RNA_expression, RNA_expression.source_hash, grouping).gene(st.session_state["overview_gene"].strip())
+        except KeyError:
+            summary = None
+        retrieval_time = time.perf_counter() - start
+        if summary is None:
+            col_1_tab_tissues.warning("Gene not found, check the name in the searchbox of the results.")
+        else:
+            # Plot the median and interquartile range of each group, sorted by median
+            summary = summary.sort_values("Median", ascending=False)
+            fig = px.bar(summary, x=summary.columns[0], y="Median", color="Detection rate", color_continuous_scale="Cividis",
+                         error_y=summary["Q3"] - summary["Median"], error_y_minus=summary["Median"] - summary["Q1"],
+                         hover_data=["Cell lines", "Mean", "Q1", "Q3"])
+            fig.update_layout(yaxis_title="log2(TPM+1)", height=500)
+            with col_2_tab_tissues:
+                st.plotly_chart(fig, use_container_width=True)
+                st.caption(f"Summaries of {len(summary)} groups retrieved in {retrieval_time * 1000:.0f} ms. "
+                           f"Detection rate: fraction of cell lines with log2(TPM+1) > {depmap_data.DETECTION_THRESHOLD}.")
+            with col_1_tab_tissues:
+                st.dataframe(summary.round(3), hide_index=True, use_container_width=True)
+
+###################
+
+# Cached function to prepare the standardized matrix for the co-expression search, once per dataset and
+# correlation method (it is a float32 copy of the matrix, shared by all sessions)
+@st.cache_resource(show_spinner=False, max_entries=len(depmap_data.COEXPRESSION_METHODS) * depmap_data.MAX_LOADED_RELEASES)
+def get_coexpression_index(_expression_store, source_hash, method):
+    return depmap_data.CoexpressionIndex(_expression_store.values.T, _expression_store.genes, method)
+
+# Find the genes most correlated with a gene, across all cell lines or only the ones in the results
+with tab_coexpression:
+    col_1_tab_coexpression, col_2_tab_coexpression = st.columns([1, 2])
+    with col_1_tab_coexpression:
+        st.text_input(key="coexpression_gene", label="Gene:")
+        st.radio(key="coexpression_method", label="Correlation:", options=depmap_data.COEXPRESSION_METHODS, horizontal=True)
+        st.number_input(key="coexpression_k", label="Number of genes:", min_value=1, max_value=1000, value=depmap_data.COEXPRESSION_TOP_K)
+        st.toggle(key="coexpression_selected", label="Only the cell lines in the results", 
+                  disabled="extracted_RNA_data" not in st.session_state)
+    if st.session_state["coexpression_gene"]:
+        gene = st.session_state["coexpression_gene"].strip()
+        method = st.session_state["coexpression_method"]
+        with st.spinner("Preparing the co-expression search (only the first time)..."):
+            start = time.perf_counter()
+
+            # The few cell lines in the results are standardized on the fly, all of them are cached
+            if st.session_state["coexpression_selected"] and "extracted_RNA_data" in st.session_state:
+                cell_lines = st.session_state["extracted_RNA_data"].columns[1:]
+                coexpression_index = depmap_data.CoexpressionIndex(
+                    RNA_expression.values[RNA_expression.cell_positions(cell_lines)].T, RNA_expression.genes, method)
+            else:
+                cell_lines = RNA_expression.cells
+                coexpression_index = get_coexpression_index(RNA_expression, RNA_expression.source_hash, method)
+            try:
+                coexpressed_genes = coexpression_index.top(gene, st.session_state["coexpression_k"])
+            except KeyError:
+                coexpressed_genes = None
+            query_time = time.perf_counter() - start
+        if coexpressed_genes is None:
+            col_1_tab_coexpression.warning("Gene not found, check the name in the searchbox of the results.")
+        elif len(cell_lines) < 3:
+            col_1_tab_coexpression.warning("At least 3 cell lines are needed to compute correlations.")
+        else:
+            with col_2_tab_coexpression:
+                st.dataframe(coexpressed_genes.round(4), hide_index=True, use_container_width=True)
+                st.caption(f"{method} correlation across {len(cell_lines)} cell lines, found in {query_time * 1000:.0f} ms.")
+
+###################
+
+# Cached function to prepare the differential expression, which sums the rows of all the cell lines of the
+# menu once per dataset (models without a name are not part of "All other cell lines")
+@st.cache_resource(show_spinner=False, max_entries=depmap_data.MAX_LOADED_RELEASES)
+def get_differential_expression(_expression_store, _cell_menu_index, source_hash):
+    return depmap_data.DifferentialExpression(_expression_store, _cell_menu_index.named_cells)
+
+# Function to get the cell lines of a group chosen in the compare groups tab (None means all the others)
+def get_group(choice):
+    if choice == "Your selections":
+        return [name for name in st.session_state["keep_cells_final"] if name]
+    elif choice == "Saved selections":
+        return st.session_state.get("saved_cells", [])
+    elif choice == "All other cell lines":
+        return None
+    return cell_menu_index.search_tissue(choice.replace("Tissue: ", "", 1))["Cell line"].tolist()
+
+# Compare every gene between two groups of cell lines: selections (current or saved) or tissues
+with tab_groups:
+    col_1_tab_groups, col_2_tab_groups = st.columns([1, 2])
+    with col_1_tab_groups:
+        st.button(label="Save my selections as a group", 
+                  on_click=lambda: st.session_state.update(saved_cells=get_group("Your selections")))
+        st.caption(f"Saved selections: {len(st.session_state.get('saved_cells', []))} cell lines.")
+        group_options = ["Your selections", "Saved selections"] + [f"Tissue: {tissue}" for tissue in cell_menu_index.tissues[1:]]
+        st.selectbox(key="group_a", label="Group A:", options=group_options)
+        st.selectbox(key="group_b", label="Group B:", options=["All other cell lines"] + group_options)
+        compare_button = st.button(label="Compare groups", type="primary")
+
+    if compare_button:
+        group_a, group_b = get_group(st.session_state["group_a"]), get_group(st.session_state["group_b"])
+
+        # The cell lines in both groups are only kept in group A (group B is the rest of the menu if not given)
+        group_a = list(dict.fromkeys(group_a))
+        if group_b is None:
+            group_b_size = len(cell_menu_index.named_cells) - sum(name in cell_menu_index.name_positions for name in group_a)
+        else:
+            group_b = [name for name in dict.fromkeys(group_b) if name not in set(group_a)]
+            group_b_size = len(group_b)
+
+        if st.session_state["group_a"] == st.session_state["group_b"]:
+            col_1_tab_groups.warning("Choose two different groups.")
+        elif len(group_a) < depmap_data.MIN_GROUP_SIZE or group_b_size < depmap_data.MIN_GROUP_SIZE:
+            col_1_tab_groups.warning(f"Each group needs at least {depmap_data.MIN_GROUP_SIZE} cell lines "
+                                     "(the cell lines in both groups are only counted in group A).")
+        else:
+            with st.spinner("Comparing groups..."):
+                start = time.perf_counter()
+                comparison = get_differential_expression(RNA_expression, cell_menu_index, RNA_expression.source_hash).compare(group_a, group_b)
+                comparison_time = time.perf_counter() - start
+                st.session_state["group_comparison"] = {
+                    "results": comparison, 
+                    "file": depmap_data.export_frame(comparison, "csv.gz"), 
+                    "caption": f"{st.session_state['group_a']} vs {st.session_state['group_b']}: Welch's t-test of "
+                               f"{len(comparison)} genes in {comparison_time * 1000:.0f} ms (q-values by Benjamini-Hochberg)."}
+
+    # Show the ranked table and a volcano plot (WebGL, so the ~19k points stay responsive)
+    if "group_comparison" in st.session_state:
+        comparison = st.session_state["group_comparison"]["results"]
+        with col_2_tab_groups:
+            fig = px.scatter(comparison, x="Difference", y=-np.log10(comparison["p-value"]), hover_name="Gene",
+                             color=np.where(comparison["q-value"] < 0.05, "q < 0.05", "q >= 0.05"), render_mode="webgl",
+                             color_discrete_sequence=px.colors.qualitative.Dark2)
+            fig.update_layout(xaxis_title="Mean difference A - B (log2(TPM+1))", yaxis_title="-log10(p-value)", legend_title="", height=500)
+            st.plotly_chart(fig, use_container_width=True)
+            st.caption(st.session_state["group_comparison"]["caption"])
+        with col_1_tab_groups:
+            st.dataframe(comparison, hide_index=True, use_container_width=True)
+            st.download_button(label="Download table (.csv.gz)", data=st.session_state["group_comparison"]["file"],
+                               file_name="RNA_Group_comparison.csv.gz")
+
+###################
+
+# Cached function to prepare the z-scores or ranks used to score gene sets, once per dataset and method
+@st.cache_resource(show_spinner=False, max_entries=len(depmap_data.GENE_SET_METHODS) * depmap_data.MAX_LOADED_RELEASES)
+def get_gene_set_scorer(_expression_store, source_hash, method):
+    return depmap_data.GeneSetScorer(_expression_store, method)
+
+# Score uploaded gene sets (GMT files or plain lists of genes) in all the cell lines
+with tab_gene_sets:
+    col_1_tab_gene_sets, col_2_tab_gene_sets = st.columns([1, 2])
+    with col_1_tab_gene_sets:
+        gene_set_files = st.file_uploader(key="gene_set_files", label="Upload gene sets (.gmt files or lists of genes)", 
+                                          type=["gmt", "txt", "csv", "tsv"], accept_multiple_files=True)
+        gene_sets = {}
+        for gene_set_file in gene_set_files or []:
+            gene_sets.update(depmap_data.read_gene_sets(gene_set_file.name, gene_set_file.getvalue().decode("utf-8", errors="replace")))
+        st.caption(f"Gene sets found: {len(gene_sets)}")
+        st.radio(key="gene_set_method", label="Score:", options=depmap_data.GENE_SET_METHODS, horizontal=True)
+        st.selectbox(key="gene_set_format", label="File format:", options=list(depmap_data.EXPORT_FORMATS))
+        score_button = st.button(label="Score gene sets", type="primary", disabled=not gene_sets)
+
+    if score_button and gene_sets:
+        with st.spinner("Scoring gene sets (preparing the matrix only the first time)..."):
+            gene_set_scorer = get_gene_set_scorer(RNA_expression, RNA_expression.source_hash, st.session_state["gene_set_method"])
+            start = time.perf_counter()
+            scores = gene_set_scorer.score(gene_sets)
+            scoring_time = time.perf_counter() - start
+            file_format = depmap_data.EXPORT_FORMATS[st.session_state["gene_set_format"]]
+            st.session_state["gene_set_scores"] = {
+                "scores": scores, 
+                "file": depmap_data.export_frame(scores.reset_index(), file_format),
+                "file_name": f"RNA_Gene_set_scores.{file_format}",
+                "genes_found": pd.DataFrame({"Gene set": list(gene_sets), "Genes": [len(genes) for genes in gene_sets.values()],
+                                             "Genes found": gene_set_scorer.membership(gene_sets)[1]}),
+                "caption": f"{st.session_state['gene_set_method']} of {len(gene_sets)} gene sets in {len(scores)} cell lines, "
+                           f"scored in {scoring_time * 1000:.0f} ms."}
+
+    # Show the scores, the genes of each set found in the dataset and the file to download
+    if "gene_set_scores" in st.session_state:
+        with col_2_tab_gene_sets:
+            st.dataframe(st.session_state["gene_set_scores"]["scores"].round(4), use_container_width=True)
+            st.caption(st.session_state["gene_set_scores"]["caption"])
+        with col_1_tab_gene_sets:
+            st.dataframe(st.session_state["gene_set_scores"]["genes_found"], hide_index=True, use_container_width=True)
+            st.download_button(label="Download scores", data=st.session_state["gene_set_scores"]["file"],
+                               file_name=st.session_state["gene_set_scores"]["file_name"])
+
+###################
+
+# Compare the value of one gene in one cell line across the releases currently loaded in the app
+with tab_releases:
+    loaded_releases = get_release_registry().loaded_releases()
+    st.caption(f"Releases currently loaded: {', '.join(loaded_releases)}. Other releases can be loaded "
+               "with the menu in the left column (they are loaded once and shared by all sessions).")
+    col_1_tab_releases, col_2_tab_releases = st.columns([1, 2])
+    with col_1_tab_releases:
+        st.text_input(key="compare_gene", label="Gene:")
+        st.selectbox(key="compare_cell_line", label="Cell line:", options=[""] + cell_menu["Cell line"].tolist())
+    if st.session_state["compare_gene"] and st.session_state["compare_cell_line"]:
+        with col_2_tab_releases:
+            st.dataframe(depmap_data.compare_releases(loaded_releases, st.session_state["compare_gene"].strip(),
+                                                      st.session_state["compare_cell_line"]), hide_index=True)
+
+###################################################################################################
@@ -0,0 +1,181 @@
+'''
+App made by:
+    Eduardo Reyes Alvarez, Ph.D.
+Contact:
+    eduardo_reyes09@hotmail.com
+
+Script description:
+    Benchmark of the pre-processing done by get_files in the app 001_RNA_expression_DepMap. It writes
+    synthetic DepMap-like csv files of the requested size, then builds the dataset with the previous
+    pandas approach (read_csv + transpose + rename + sort) and with the streaming snapshot builder, each
+    one in a fresh process, and reports the time and peak memory (RSS) of both. Then it reports the 
+    memory added by 1, 10 and 50 simulated sessions when the dataset is copied to every session 
+    (previous st.cache_data approach) or shared by all of them (st.cache_resource approach).
+    The time and peak memory of every stage of both pipelines are listed too, and can be appended to a
+    JSON lines log (--log) to compare runs and catch regressions.
+
+Usage:
+    python benchmark.py --cells 1500 --genes 19000 --log benchmark_timings.jsonl
+
+'''
+###################################################################################################
+
+# Import the required libraries
+
+import os
+import pickle
+import argparse
+import tracemalloc
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+import pandas as pd
+
+import depmap_data
+
+###################################################################################################
+
+# Function to write a RNASeq csv and a cell info csv with the same layout as the DepMap files
+def make_synthetic_files(folder, n_cells, n_genes, seed=0):
+
+    rng = np.random.default_rng(seed)
+    model_IDs = [f"ACH-{i:06d}" for i in range(n_cells)]
+    genes = [f"GENE{i} ({i + 1})" for i in range(n_genes)]
+
+    # Write the RNASeq file in blocks of rows so this script does not need much memory either
+    rna_file = os.path.join(folder, "DepMap_RNASeq_synthetic.csv")
+    with open(rna_file, "w") as f:
+        f.write("," + ",".join(genes) + "\n")
+        for start in range(0, n_cells, 100):
+            block = pd.DataFrame(rng.gamma(1.0, 2.0, (min(100, n_cells - start), n_genes)).round(6),
+                                 index=model_IDs[start:start + 100])
+            block.to_csv(f, header=False)
+
+    # A few cell lines have no name, and the info file has some models without RNASeq data
+    cell_info = pd.DataFrame({"ModelID": model_IDs + [f"ACH-9{i:05d}" for i in range(10)]})
+    cell_info["CellLineName"] = [f"CELL{i}" for i in range(len(cell_info))]
+    cell_info.loc[::50, "CellLineName"] = None
+    cell_info["OncotreeLineage"] = rng.choice(["Lung", "Breast", "Skin", "Bowel", "Myeloid"], len(cell_info))
+    cell_info["OncotreePrimaryDisease"] = rng.choice(["Disease A", "Disease B", "Disease C"], len(cell_info))
+    cell_info_file = os.path.join(folder, "DepMap_CellInfo_synthetic.csv")
+    cell_info.to_csv(cell_info_file, index=False)
+
+    return rna_file, cell_info_file
+
+###################################################################################################
+
+# The previous get_files approach, kept here only as a reference for the comparison
+def pandas_pipeline(rna_file, cell_info_file, folder, timer):
+
+    cell_menu = depmap_data.read_cell_info(cell_info_file)
+    timer.lap("Read cell line information")
+    RNA_expression = pd.read_csv(rna_file)
+    timer.lap("read_csv")
+    RNA_expression = RNA_expression.set_index("Unnamed: 0").T
+    timer.lap("Transpose")
+    RNA_expression["Gene"] = RNA_expression.index
+    RNA_expression["Gene"] = RNA_expression["Gene"].str.replace(r'\s\(\d+\)$', '', regex=True)
+    RNA_expression = RNA_expression.reset_index(drop=True)
+    RNA_expression = RNA_expression.set_index("Gene")
+    timer.lap("Clean gene names")
+    id_to_cell_line = dict(zip(cell_menu["Achilles ID"], cell_menu["Cell line"]))
+    RNA_expression.columns = [id_to_cell_line.get(col, col) for col in RNA_expression.columns]
+    timer.lap("Rename cell lines")
+    RNA_expression = RNA_expression.sort_index(axis=1)
+    RNA_expression = RNA_expression.sort_index()
+    timer.lap("Sort")
+
+    return RNA_expression.shape
+
+###################
+
+# The streaming snapshot builder used by the app (timed with the same stages as when the app loads it)
+def snapshot_pipeline(rna_file, cell_info_file, folder, timer):
+
+    depmap_data.build_snapshot(rna_file, cell_info_file, "benchmark", folder=folder, timer=timer)
+    expression_store, _ = depmap_data.load_snapshot("benchmark", folder=folder)
+    timer.lap("Open snapshot")
+
+    return expression_store.values.shape
+
+###################
+
+# Function executed in a fresh process, so the peak memory measured belongs to one pipeline only
+def measure(pipeline, rna_file, cell_info_file, folder, log_file=None):
+
+    timer = depmap_data.StageTimer(f"benchmark {pipeline.__name__}", log_file)
+    shape = pipeline(rna_file, cell_info_file, folder, timer)
+
+    return shape, timer.total_seconds(), depmap_data.peak_memory_MB(), timer.timings
+
+###################################################################################################
+
+# Function to measure the memory each session adds when the dataset is copied to every session 
+# (previous st.cache_data approach) or shared by all of them (st.cache_resource approach)
+def session_memory_report(folder, session_counts, n_selected=10):
+
+    expression_store, cell_menu = depmap_data.load_snapshot("benchmark", folder=folder)
+    rng = np.random.default_rng(0)
+    tracemalloc.start()
+
+    # Previous approach: each session got an unpickled copy of the float64 dataframe and the cell menu
+    # It grows linearly, so it is measured for one session and scaled (it would need GBs of RAM)
+    dataset = (expression_store.to_frame().astype(np.float64), cell_menu)
+    before = tracemalloc.get_traced_memory()[0]
+    session_copy = pickle.loads(pickle.dumps(dataset))
+    copy_bytes = tracemalloc.get_traced_memory()[0] - before
+    del dataset, session_copy
+
+    # Current approach: the sessions only keep their selections and the data extracted for them
+    print(f"{'Sessions':>8} | {'Copied dataset (previous)':>25} | {'Shared dataset (current)':>24} | Per session (current)")
+    for n_sessions in session_counts:
+        before = tracemalloc.get_traced_memory()[0]
+        sessions = []
+        for _ in range(n_sessions):
+            selected = sorted(rng.choice(expression_store.cells, n_selected, replace=False).tolist())
+            extracted = expression_store.extract(selected).reset_index(drop=False)
+            sessions.append({"keep_cells_final": selected, "extracted_RNA_data": extracted, "checked_genes": set()})
+        shared_bytes = tracemalloc.get_traced_memory()[0] - before
+        print(f"{n_sessions:>8} | {n_sessions * copy_bytes / 2**20:>22.0f} MB | {shared_bytes / 2**20:>21.1f} MB | "
+              f"{shared_bytes / n_sessions / 2**20:.2f} MB")
+        del sessions
+
+    tracemalloc.stop()
+    matrix_MB = os.path.getsize(os.path.join(folder, "expression.npy")) / 2**20
+    print(f"\nThe shared matrix ({matrix_MB:.0f} MB file) is memory-mapped once and cached by the operating system for all sessions.")
+
+###################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time and peak memory of the DepMap pre-processing.")
+    parser.add_argument("--cells", type=int, default=1500, help="Number of cell lines (csv rows)")
+    parser.add_argument("--genes", type=int, default=19000, help="Number of genes (csv columns)")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 10, 50], help="Numbers of simulated sessions")
+    parser.add_argument("--log", default=None, help="JSON lines file to append the stage timings to (to compare runs)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        print(f"Writing synthetic files ({args.cells} cell lines x {args.genes} genes)...")
+        rna_file, cell_info_file = make_synthetic_files(folder, args.cells, args.genes)
+        print(f"RNASeq csv size: {os.path.getsize(rna_file) / 2**20:.0f} MB")
+        print(f"Matrix size as float32: {args.cells * args.genes * 4 / 2**20:.0f} MB\n")
+
+        # Each pipeline runs in a new (spawned) process so they do not inherit each other's memory
+        # The stages show the time of each one and the peak memory of the process when it finished
+        for pipeline in [pandas_pipeline, snapshot_pipeline]:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                shape, seconds, peak_rss_MB, timings = executor.submit(measure, pipeline, rna_file, cell_info_file,
+                                                                        os.path.join(folder, "snapshot"), args.log).result()
+            peak_text = f"{peak_rss_MB:.0f} MB" if peak_rss_MB is not None else "n/a"
+            print(f"{pipeline.__name__:>18}: {seconds:.1f} s, peak RSS {peak_text}, matrix shape {shape}")
+            for timing in timings:
+                stage_peak_text = f"{timing['peak_memory_MB']:.0f} MB" if timing["peak_memory_MB"] is not None else "n/a"
+                print(f"{'':>20}{timing['stage']:<28} {timing['seconds']:>7.2f} s   peak RSS {stage_peak_text}")
+
+        # Memory added by the sessions, using the snapshot built by the last pipeline
+        print(f"\nMemory added by simulated sessions (each one with 10 cell lines extracted):")
+        session_memory_report(os.path.join(folder, "snapshot"), args.sessions)
+
+###################################################################################################
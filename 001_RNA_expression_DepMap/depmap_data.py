@@ -0,0 +1,1103 @@
+'''
+App made by:
+    Eduardo Reyes Alvarez, Ph.D.
+Contact:
+    eduardo_reyes09@hotmail.com
+
+Module description:
+    Data helpers for the app 001_RNA_expression_DepMap. Everything here is plain pandas/numpy code
+    (no streamlit calls), so the app only has to report progress and display the results.
+
+'''
+###################################################################################################
+
+# Import the required libraries
+
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+import warnings
+from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+import pandas as pd
+import openpyxl
+import requests
+from scipy import sparse, stats
+
+# The resource module only exists on Unix, on Windows the peak memory is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+###################################################################################################
+
+# DepMap releases available in the app, with the files to download and the folder (in the working
+# directory) where the pre-processed dataset is saved after the first use. The figshare repository of
+# each release lists the direct download links (and md5 checksums) of its files. When the md5 is not
+# written here, it is looked up (with the file size) from the figshare API of the article before downloading.
+# 23Q4: https://doi.org/10.25452/figshare.plus.24667905.v2
+RELEASES = {
+    "23Q4": {
+        "figshare_article": 24667905,
+        "rna_file": "DepMap_RNASeq_23Q4.csv",
+        "rna_url": "https://plus.figshare.com/ndownloader/files/43347204",
+        "rna_md5": None,
+        "cell_info_file": "DepMap_CellInfo_23Q4.csv",
+        "cell_info_url": "https://plus.figshare.com/ndownloader/files/43746708",
+        "cell_info_md5": None,
+        "snapshot_folder": "DepMap_cache_23Q4",
+    },
+}
+DEFAULT_RELEASE = "23Q4"
+
+# Maximum number of releases kept loaded at the same time (the least recently used one is dropped)
+MAX_LOADED_RELEASES = 2
+
+# Files that make a complete snapshot of a release
+SNAPSHOT_FILES = ["expression.npy", "genes.npy", "cells.npy", "cell_menu.parquet", "source_hash.txt"]
+
+# Maximum number of suggestions returned by the gene searchbox
+GENE_SEARCH_LIMIT = 50
+
+# File formats offered to download the extracted data (label shown: file extension)
+EXPORT_FORMATS = {"Excel (.xlsx)": "xlsx", "CSV (.csv.gz)": "csv.gz", "Parquet (.parquet)": "parquet"}
+
+# Limits of the data sent to the browser by the gene plots: genes drawn as bars, values in a heatmap, and
+# rows (genes) and columns (cell lines) of a heatmap (more of them are averaged to stay under the limits)
+PLOT_MAX_BAR_GENES = 30
+PLOT_MAX_HEATMAP_VALUES = 20000
+PLOT_MAX_HEATMAP_ROWS = 400
+PLOT_MAX_HEATMAP_COLUMNS = 100
+
+# Cell menu columns used to group the cell lines for the precomputed summaries (file name: column)
+SUMMARY_GROUPINGS = {"lineage": "Tissue", "disease": "Disease"}
+
+# Statistics precomputed for each gene in each group of cell lines
+SUMMARY_STATISTICS = ["Mean", "Median", "Q1", "Q3", "Detection rate"]
+
+# A gene is considered detected in a cell line above this value (log2(TPM+1) > 1 means TPM > 1)
+DETECTION_THRESHOLD = 1.0
+
+# Number of rows per page offered in the genes table of the results
+GENE_TABLE_PAGE_SIZES = [50, 100, 250]
+
+# Correlation methods and default number of genes returned by the co-expression search
+COEXPRESSION_METHODS = ["Pearson", "Spearman"]
+COEXPRESSION_TOP_K = 50
+
+# Number of similar cell lines returned by the profile search, and number of most variable genes used
+# when the search is restricted to the highly variable genes
+SIMILAR_CELLS_TOP_K = 20
+VARIABLE_GENES = 2000
+
+# Minimum number of cell lines in each group compared by the differential expression
+MIN_GROUP_SIZE = 2
+
+# Methods to score gene sets in each cell line
+GENE_SET_METHODS = ["Mean z-score", "Mean rank"]
+
+# Number of name searches of the cell line menu kept in memory
+NAME_CACHE_SIZE = 64
+
+# Address of the figshare API with the details (md5 checksum, size) of each file of an article
+FIGSHARE_FILE_API = "https://api.figshare.com/v2/articles/{article}/files/{file_id}"
+
+# Headers used to request the files from figshare
+DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3',
+    'Referer': 'https://plus.figshare.com'
+}
+
+# Number of cell lines (rows of the RNASeq csv) between progress updates when building the snapshot
+REPORT_EVERY = 100
+
+# File (in the working directory) where the time of each stage is appended, one JSON object per line
+TIMING_LOG = "DepMap_timings.jsonl"
+
+###################################################################################################
+
+# Function to get the peak memory (RSS) of this process so far, in MB (None where it is not available)
+def peak_memory_MB():
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is given in kilobytes on Linux (and in bytes on macOS)
+    return peak_rss / 2**20 if sys.platform == "darwin" else peak_rss / 2**10
+
+###################
+
+# Class to time the stages of a pipeline (loading a release, extracting results...) with little overhead
+# Each call to lap() closes a stage: it records the time since the previous one and the peak memory of
+# the process so far (so the stage that raised it stands out), reports it, and appends it to the log.
+class StageTimer:
+
+    log_lock = threading.Lock()
+
+    def __init__(self, pipeline, log_file=None, report=lambda label: None):
+        self.pipeline = pipeline
+        self.log_file = log_file
+        self.report = report
+        self.timings = []
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        timing = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "pipeline": self.pipeline, "stage": stage,
+                  "seconds": round(now - self.last, 4), "peak_memory_MB": peak_memory_MB()}
+        self.timings.append(timing)
+        self.last = now
+
+        peak_text = f", peak memory {timing['peak_memory_MB']:.0f} MB" if timing["peak_memory_MB"] is not None else ""
+        self.report(f"Timing - {stage}: {timing['seconds']:.2f} s{peak_text}")
+        if self.log_file is not None:
+            with StageTimer.log_lock, open(self.log_file, "a") as f:
+                f.write(json.dumps(timing) + "\n")
+
+        return timing
+
+    # Total time of the stages recorded so far
+    def total_seconds(self):
+        return sum(timing["seconds"] for timing in self.timings)
+
+###################################################################################################
+
+# Function to get a single hash for the content of the source csv files (read in blocks, not at once)
+def hash_source_files(*file_paths, block_size=2**20):
+
+    file_hash = hashlib.sha256()
+    for file_path in file_paths:
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+###################################################################################################
+
+# Error raised when a file could not be downloaded (or verified) after all the attempts
+class DownloadError(Exception):
+    pass
+
+###################
+
+# Function to get the checksum of a file (read in blocks, not at once)
+def file_checksum(file_path, algorithm="md5", block_size=2**20):
+
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            file_hash.update(block)
+
+    return file_hash.hexdigest()
+
+###################
+
+# Function to get the md5 checksum and size (bytes) of a figshare file from the API of its article
+# The file ID is the last part of its download link. Returns None for both if they can not be found.
+def figshare_file_info(url, article, headers=DOWNLOAD_HEADERS, timeout=30):
+
+    file_id = url.rstrip("/").rsplit("/", 1)[-1]
+    try:
+        response = requests.get(FIGSHARE_FILE_API.format(article=article, file_id=file_id), headers=headers, timeout=timeout)
+        response.raise_for_status()
+        file_info = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None, None
+
+    return file_info.get("computed_md5") or file_info.get("supplied_md5") or None, file_info.get("size")
+
+###################
+
+# Function to download a file in chunks to a temporary .part file, which is renamed to the final name
+# only when the download is complete and verified. A failed attempt (or run of the app) resumes from 
+# the bytes already saved with a HTTP Range request instead of starting again from byte zero.
+def download_file(url, local_filename, md5=None, size=None, headers=DOWNLOAD_HEADERS, retries=3, timeout=60,
+                  chunk_size=2**20, progress=None):
+
+    partial_file = local_filename + ".part"
+    for attempt in range(retries):
+        try:
+            # Ask only for the missing bytes if part of the file was already downloaded
+            # A .part file larger than the remote file can not be resumed, so it is started again
+            bytes_done = os.path.getsize(partial_file) if os.path.isfile(partial_file) else 0
+            if size is not None and bytes_done > size:
+                os.remove(partial_file)
+                bytes_done = 0
+            request_headers = dict(headers, Range=f"bytes={bytes_done}-") if bytes_done else headers
+
+            with requests.get(url, headers=request_headers, stream=True, timeout=timeout) as response:
+
+                # 416 means the range starts at the end of the file, so the .part file should be complete
+                # Its size is compared to the remote one (known or sent as "bytes */size"), and a .part file 
+                # that can not be verified that way (or with the md5) is deleted so the next attempt starts again
+                if response.status_code == 416:
+                    remote_size = size
+                    content_range = response.headers.get("Content-Range", "")
+                    if remote_size is None and content_range.startswith("bytes */"):
+                        remote_size = int(content_range.split("/")[-1])
+                    if (remote_size is None and md5 is None) or (remote_size is not None and bytes_done != remote_size):
+                        os.remove(partial_file)
+                        raise DownloadError(f"{local_filename}: the partial file does not match the remote file")
+                else:
+                    response.raise_for_status()
+
+                    # A server that does not support ranges sends the whole file again (200 instead of 206)
+                    if response.status_code != 206:
+                        bytes_done = 0
+                    content_length = response.headers.get("Content-Length")
+                    expected_size = bytes_done + int(content_length) if content_length is not None else None
+
+                    with open(partial_file, "ab" if bytes_done else "wb") as f:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            f.write(chunk)
+                            bytes_done += len(chunk)
+                            if progress is not None:
+                                progress[local_filename] = bytes_done
+
+                    if expected_size is not None and bytes_done != expected_size:
+                        raise DownloadError(f"{local_filename}: got {bytes_done} of {expected_size} bytes")
+
+            # Verify the complete file, a corrupted one is deleted so the next attempt starts again
+            if size is not None and os.path.getsize(partial_file) != size:
+                os.remove(partial_file)
+                raise DownloadError(f"{local_filename}: the size does not match ({size} bytes expected)")
+            if md5 is not None and file_checksum(partial_file, "md5") != md5:
+                os.remove(partial_file)
+                raise DownloadError(f"{local_filename}: the md5 checksum does not match")
+
+            os.replace(partial_file, local_filename)
+            return
+
+        except (requests.exceptions.RequestException, OSError, DownloadError) as e:
+            if attempt < retries - 1:
+                time.sleep(2 ** attempt)
+            else:
+                raise DownloadError(f"Error downloading {local_filename} after {retries} attempts: {e}") from e
+
+###################
+
+# Function to download several files at the same time (one thread each), reporting the progress from 
+# the calling thread (streamlit widgets can only be updated from the thread running the script)
+def download_files(downloads, report=lambda label: None, **kwargs):
+
+    progress = {local_filename: 0 for _, local_filename, _, _ in downloads}
+    with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+        futures = [executor.submit(download_file, url, local_filename, md5, size, progress=progress, **kwargs) 
+                   for url, local_filename, md5, size in downloads]
+        while wait(futures, timeout=1).not_done:
+            report(f"Downloading files... ({sum(progress.values()) / 2**20:.0f} MB)")
+
+        # Raise the error of any download that failed
+        for future in futures:
+            future.result()
+
+###################################################################################################
+
+# Function to read the cell line information and keep the relevant columns sorted by cell line name
+def read_cell_info(cell_info_file):
+
+    sample_IDs = pd.read_csv(cell_info_file)
+    sample_IDs = sample_IDs.sort_values(by=["CellLineName"])
+    sample_IDs = sample_IDs[sample_IDs["CellLineName"].notna()]
+    sample_IDs = sample_IDs.reset_index(drop=True)
+    cell_menu = sample_IDs[["ModelID", "CellLineName", "OncotreeLineage", "OncotreePrimaryDisease"]]
+    cell_menu.columns = ["Achilles ID", "Cell line", "Tissue", "Disease"]
+
+    return cell_menu
+
+###################
+
+# Function to get the cell line names used in the dataset from names or DepMap IDs (ACH-...)
+# Names not found in the cell menu are returned as given (cell lines without a name keep their ID)
+def resolve_cell_lines(cell_menu, names):
+    id_to_cell_line = dict(zip(cell_menu["Achilles ID"], cell_menu["Cell line"]))
+    return [id_to_cell_line.get(name, name) for name in names]
+
+###################################################################################################
+
+# Class to hold the expression matrix in a compact float32 array backed by a memory-mapped file
+# The values are stored as cell lines x genes, so the profile of each cell line is one contiguous row
+# (a zero-copy view of the file). The gene and cell line names are kept as sorted arrays to find the 
+# position of any name by binary search instead of building pandas indexes.
+class ExpressionStore:
+
+    def __init__(self, values, genes, cells, folder=None, source_hash=None):
+        self.values = values
+        self.genes = genes
+        self.cells = cells
+        self.folder = folder
+        self.source_hash = source_hash
+
+    # Open the store saved in a snapshot folder without reading the matrix into memory
+    @classmethod
+    def open(cls, folder):
+        folder = os.path.abspath(folder)
+        values = np.load(os.path.join(folder, "expression.npy"), mmap_mode="r")
+        genes = np.load(os.path.join(folder, "genes.npy"))
+        cells = np.load(os.path.join(folder, "cells.npy"))
+        with open(os.path.join(folder, "source_hash.txt")) as f:
+            source_hash = f.read().strip()
+
+        return cls(values, genes, cells, folder, source_hash)
+
+    # A memory-mapped store is pickled (e.g. by st.cache_data) as its folder only, so each copy maps the 
+    # same file and all sessions share the pages cached by the operating system
+    def __getstate__(self):
+        if self.folder is not None:
+            return {"folder": self.folder}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if list(state) == ["folder"]:
+            state = ExpressionStore.open(state["folder"]).__dict__
+        self.__dict__.update(state)
+
+    # Positions of the given names in the sorted index arrays (raises KeyError like .loc for missing names)
+    @staticmethod
+    def _find(index, names):
+        names = np.asarray(names, dtype=str)
+        positions = np.searchsorted(index, names).clip(max=len(index) - 1)
+        missing = index[positions] != names
+        if missing.any():
+            raise KeyError(f"Not in the dataset: {names[missing].tolist()}")
+        return positions
+
+    def gene_positions(self, gene_names):
+        return self._find(self.genes, gene_names)
+
+    def cell_positions(self, cell_names):
+        return self._find(self.cells, cell_names)
+
+    # The profile (all genes) of one cell line, as a view of the memory-mapped array
+    def profile(self, cell_name):
+        return self.values[self.cell_positions([cell_name])[0]]
+
+    # Get the whole matrix as a genes x cell lines dataframe (wraps the array, nothing is copied)
+    def to_frame(self):
+        return pd.DataFrame(self.values.T, index=pd.Index(self.genes, name="Gene"), columns=self.cells, copy=False)
+
+    # Get the genes x cell lines dataframe for the selected cell lines (only their rows are read and copied)
+    # All the genes are included unless a list of genes is given (raises KeyError for any missing name)
+    def extract(self, cell_names, gene_names=None):
+        cell_names = list(cell_names)
+        values = np.take(self.values, self.cell_positions(cell_names), axis=0)
+        if gene_names is None:
+            return pd.DataFrame(values.T, index=pd.Index(self.genes, name="Gene"), columns=cell_names)
+
+        gene_names = list(gene_names)
+        values = np.take(values, self.gene_positions(gene_names), axis=1)
+        return pd.DataFrame(values.T, index=pd.Index(gene_names, name="Gene"), columns=cell_names)
+
+###################################################################################################
+
+# Class to search gene names while the user types (built once per dataset, then reused by all searches)
+# The lowercase names are kept sorted, so all the names starting with the search term are one range
+# found by binary search. Names containing the term elsewhere are found through a map from each 
+# trigram (3 consecutive characters) to the names that contain it, so only a few candidates are checked.
+class GeneIndex:
+
+    def __init__(self, gene_names):
+        gene_names = np.asarray(gene_names, dtype=str)
+        lowercase_names = np.char.lower(gene_names)
+        order = np.argsort(lowercase_names, kind="stable")
+        self.names = gene_names[order]
+        self.lowercase_names = lowercase_names[order]
+
+        # Positions (in the sorted arrays) of the names containing each trigram
+        trigram_positions = {}
+        for position, name in enumerate(self.lowercase_names):
+            for trigram in {name[i:i + 3] for i in range(len(name) - 2)}:
+                trigram_positions.setdefault(trigram, []).append(position)
+        self.trigram_positions = {trigram: np.array(positions) for trigram, positions in trigram_positions.items()}
+
+    # Get up to "limit" gene names ranked as: exact match, then names starting with the term (sorted),
+    # then names containing the term (sorted)
+    def search(self, search_term, limit=GENE_SEARCH_LIMIT):
+
+        search_term = search_term.strip().lower()
+
+        # Names starting with the term are between the term and the term followed by the last character
+        # (an exact match is always the first name of that range)
+        start = np.searchsorted(self.lowercase_names, search_term, side="left")
+        end = np.searchsorted(self.lowercase_names, search_term + "\U0010ffff", side="left")
+        results = list(range(start, min(end, start + limit)))
+
+        # Only look for the term in the middle of the names if the list is not full yet
+        if len(results) < limit:
+            if len(search_term) >= 3:
+                trigrams = sorted({search_term[i:i + 3] for i in range(len(search_term) - 2)},
+                                  key=lambda trigram: len(self.trigram_positions.get(trigram, [])))
+                candidates = self.trigram_positions.get(trigrams[0], np.array([], dtype=int))
+                for trigram in trigrams[1:]:
+                    candidates = np.intersect1d(candidates, self.trigram_positions.get(trigram, []), assume_unique=True)
+            else:
+                candidates = np.flatnonzero(np.char.find(self.lowercase_names, search_term) > 0)
+            for position in candidates:
+                if (position < start or position >= end) and search_term in self.lowercase_names[position]:
+                    results.append(position)
+                    if len(results) == limit:
+                        break
+
+        return self.names[results[:limit]].tolist()
+
+###################################################################################################
+
+# Class to search the cell line menu by name or tissue (built once per dataset, shared by all sessions)
+# The menu already includes the "Keep cell line?" column, and each search returns either one of the
+# frames precomputed per tissue or rows of the shared menu, so nothing is copied on every rerun.
+# The returned frames are shared and must not be modified (st.data_editor returns an edited copy).
+class CellMenuIndex:
+
+    def __init__(self, cell_menu, name_cache_size=NAME_CACHE_SIZE):
+        self.menu = cell_menu.reset_index(drop=True)
+        self.menu.insert(len(self.menu.columns), "Keep cell line?", False)
+        self.lowercase_names = np.char.lower(self.menu["Cell line"].to_numpy(dtype=str))
+
+        # One result frame per tissue, and the sorted list of tissues for the selectbox ("" = no tissue)
+        self.tissue_results = {tissue: self.menu.iloc[positions] 
+                               for tissue, positions in self.menu.groupby("Tissue").indices.items()}
+        self.tissues = [""] + sorted(self.tissue_results)
+        self.no_results = self.menu.iloc[[]]
+        self.name_positions = {name: position for position, name in enumerate(self.menu["Cell line"])}
+        self.named_cells = np.array(list(self.name_positions), dtype=str)
+
+        # The last name searches are kept, since every checkbox click reruns the app with the same term
+        # This object is shared by all sessions (threads), so the cache is only read or changed with the lock
+        self.name_results = OrderedDict()
+        self.name_cache_size = name_cache_size
+        self.name_lock = threading.Lock()
+
+    # Get the cell lines whose name contains the search term (not case sensitive, no regex)
+    def search_name(self, search_term):
+
+        search_term = search_term.lower()
+        with self.name_lock:
+            results = self.name_results.get(search_term)
+            if results is not None:
+                self.name_results.move_to_end(search_term)
+                return results
+
+        # The search itself is done outside the lock, so other sessions are not kept waiting
+        positions = np.flatnonzero(np.char.find(self.lowercase_names, search_term) >= 0)
+        results = self.menu.iloc[positions]
+        with self.name_lock:
+            self.name_results[search_term] = results
+            self.name_results.move_to_end(search_term)
+            if len(self.name_results) > self.name_cache_size:
+                self.name_results.popitem(last=False)
+
+        return results
+
+    # Get the cell lines of a tissue
+    def search_tissue(self, tissue):
+        return self.tissue_results.get(tissue, self.no_results)
+
+    # Get the cell lines with the profiles most similar to a cell line, with their similarity (a new frame)
+    # Only the cell lines of the menu are candidates (models without a name are left out before sorting)
+    def search_similar(self, cell_name, similarity_index, k=SIMILAR_CELLS_TOP_K):
+        similar_cells = similarity_index.top(cell_name, k, candidates=self.named_cells)
+        results = self.menu.iloc[similar_cells["Cell line"].map(self.name_positions)].copy()
+        results.insert(2, "Similarity", similar_cells["Similarity"].round(4).to_numpy())
+
+        return results
+
+###################################################################################################
+
+# Function to build the snapshot from the two DepMap csv files without loading the whole csv at once
+# The RNASeq csv has one row per cell line (ModelID) and one column per gene, which is the same layout
+# as the stored matrix, so it is read row by row and each row is written straight into its final 
+# (sorted) position of a preallocated memory-mapped array. Peak memory is one row plus the array pages
+# the operating system has not written to disk yet, instead of the raw + transposed + renamed 
+# dataframes of the previous approach.
+def build_snapshot(rna_file, cell_info_file, source_hash, folder, report_every=REPORT_EVERY, report=lambda label: None, 
+                   timer=None):
+
+    timer = timer or StageTimer("build snapshot")
+    report("Importing cell line information...")
+    cell_menu = read_cell_info(cell_info_file)
+    id_to_cell_line = dict(zip(cell_menu["Achilles ID"], cell_menu["Cell line"]))
+    timer.lap("Read cell line information")
+
+    # Gene names come from the header (removing the Entrez ID suffix) and give the column order
+    report("Indexing genes and cell lines...")
+    header = pd.read_csv(rna_file, nrows=0).columns
+    genes = header[1:].str.replace(r'\s\(\d+\)$', '', regex=True).to_numpy(dtype=str)
+    gene_order = np.argsort(genes, kind="stable")
+
+    # Map the ModelIDs of the first column to cell line names (or keep the ID if it has no name)
+    # Only the text before the first comma of each line is decoded, which is much faster than parsing
+    with open(rna_file, "rb") as f:
+        next(f)
+        model_IDs = [line[:line.index(b",")].decode().strip('"') for line in f if line.strip()]
+    cells = np.array([id_to_cell_line.get(model_ID, model_ID) for model_ID in model_IDs], dtype=str)
+    cell_order = np.argsort(cells, kind="stable")
+    destination_rows = np.empty_like(cell_order)
+    destination_rows[cell_order] = np.arange(len(cell_order))
+    timer.lap("Index genes and cell lines")
+
+    # Other processes may have the old matrix memory-mapped, so the new one is written to a temporary 
+    # file that replaces it at the end (and the old hash is removed so the folder is invalid meanwhile)
+    os.makedirs(folder, exist_ok=True)
+    if os.path.isfile(os.path.join(folder, "source_hash.txt")):
+        os.remove(os.path.join(folder, "source_hash.txt"))
+    for file_name in [f"summary_{grouping}.npy" for grouping in SUMMARY_GROUPINGS] + ["embedding.npy"]:
+        if os.path.isfile(os.path.join(folder, file_name)):
+            os.remove(os.path.join(folder, file_name))
+    temporary_file = os.path.join(folder, "expression.tmp.npy")
+    values = np.lib.format.open_memmap(temporary_file, mode="w+", dtype=np.float32, shape=(len(cells), len(genes)))
+
+    # Read the values one row (cell line) at a time and write them in their sorted positions
+    # This is as fast as pd.read_csv for files with ~19k columns, and the pandas or pyarrow chunked 
+    # readers need hundreds of MB of parsing buffers for such wide rows
+    rows_done = 0
+    with open(rna_file) as f:
+        next(f)
+        for line in f:
+            if not line.strip():
+                continue
+            fields = line.rstrip("\r\n").split(",")[1:]
+            try:
+                row = np.array(fields, dtype=np.float32)
+            except ValueError:
+                row = np.array([field or "nan" for field in fields], dtype=np.float32)
+            values[destination_rows[rows_done]] = row[gene_order]
+            rows_done += 1
+            if rows_done % report_every == 0 or rows_done == len(cells):
+                report(f"Pre-processing files... ({rows_done} of {len(cells)} cell lines)")
+    values.flush()
+    del values
+    os.replace(temporary_file, os.path.join(folder, "expression.npy"))
+    timer.lap("Parse rows into the matrix")
+
+    # Save the sorted names as fixed-width text arrays (they can be memory-mapped too, no pickling)
+    np.save(os.path.join(folder, "genes.npy"), genes[gene_order])
+    np.save(os.path.join(folder, "cells.npy"), cells[cell_order])
+
+    # Since not all the cell lines in the DepMap/Achilles project have RNA Seq data, remove those from the menu
+    cell_menu = cell_menu[cell_menu["Cell line"].isin(cells)].reset_index(drop=True)
+    cell_menu.to_parquet(os.path.join(folder, "cell_menu.parquet"))
+
+    # The hash is written last, so a snapshot interrupted half-way is never considered valid
+    with open(os.path.join(folder, "source_hash.txt"), "w") as f:
+        f.write(source_hash)
+    timer.lap("Save names and cell menu")
+
+###################
+
+# Function to load the snapshot, only if it was made from the same source files (otherwise returns None)
+def load_snapshot(source_hash, folder):
+
+    if not all(os.path.isfile(os.path.join(folder, file_name)) for file_name in SNAPSHOT_FILES):
+        return None
+    with open(os.path.join(folder, "source_hash.txt")) as f:
+        if f.read().strip() != source_hash:
+            return None
+
+    expression_store = ExpressionStore.open(folder)
+    cell_menu = pd.read_parquet(os.path.join(folder, "cell_menu.parquet"))
+
+    return expression_store, cell_menu
+
+###################################################################################################
+
+# Function to write the extracted data to a file in memory, in the format chosen to download it
+# The Excel file uses a write-only workbook, which streams the rows to the file instead of keeping 
+# every cell as an object in memory like the default pandas/openpyxl writer. The index is kept as 
+# the first column, as in the files made by previous versions of the app.
+def export_frame(dataframe, file_format):
+
+    output = BytesIO()
+    if file_format == "xlsx":
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet("Search_01")
+        worksheet.append([None] + [str(column) for column in dataframe.columns])
+        for row in dataframe.itertuples(index=True, name=None):
+            worksheet.append(row)
+        workbook.save(output)
+    elif file_format == "csv.gz":
+        dataframe.to_csv(output, index=False, compression={"method": "gzip", "compresslevel": 6})
+    elif file_format == "csv":
+        dataframe.to_csv(output, index=False)
+    elif file_format == "parquet":
+        dataframe.to_parquet(output, index=False)
+    else:
+        raise ValueError(f"Unknown file format: {file_format}")
+    output.seek(0)
+
+    return output
+
+###################################################################################################
+
+# Function to precompute the summary of every gene in each group of cell lines (lineage or disease)
+# The matrix is read once, one group of rows at a time, and the results are saved as a genes x groups 
+# x statistics array in the snapshot folder, so the summaries of one gene are a single contiguous block
+def build_summaries(expression_store, cell_menu, grouping, report=lambda label: None):
+
+    column = SUMMARY_GROUPINGS[grouping]
+    groups = cell_menu.dropna(subset=[column]).groupby(column)["Cell line"]
+    group_info = pd.DataFrame({column: list(groups.groups), "Cell lines": groups.nunique().to_numpy()})
+    group_info.to_parquet(os.path.join(expression_store.folder, f"summary_{grouping}_groups.parquet"))
+
+    temporary_file = os.path.join(expression_store.folder, f"summary_{grouping}.tmp.npy")
+    summaries = np.lib.format.open_memmap(temporary_file, mode="w+", dtype=np.float32, 
+                                          shape=(len(expression_store.genes), len(group_info), len(SUMMARY_STATISTICS)))
+    for i, (group, cell_names) in enumerate(groups):
+        report(f"Summarizing expression per {grouping}... ({i + 1} of {len(group_info)})")
+        values = np.take(expression_store.values, expression_store.cell_positions(cell_names.unique()), axis=0)
+
+        # np.percentile is much faster than np.nanpercentile, which is only needed if there are NaNs
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            percentile = np.nanpercentile if np.isnan(values).any() else np.percentile
+            summaries[:, i, 0] = np.nanmean(values, axis=0)
+            summaries[:, i, 1:4] = percentile(values, [50, 25, 75], axis=0).T
+            summaries[:, i, 4] = (values > DETECTION_THRESHOLD).sum(axis=0) / (~np.isnan(values)).sum(axis=0)
+    summaries.flush()
+    del summaries
+
+    # The array is renamed last, so a summary interrupted half-way is never considered complete
+    os.replace(temporary_file, os.path.join(expression_store.folder, f"summary_{grouping}.npy"))
+
+###################
+
+# Class to read the precomputed summaries of one grouping (memory-mapped, nothing is computed here)
+class GroupSummaries:
+
+    def __init__(self, folder, grouping):
+        self.values = np.load(os.path.join(folder, f"summary_{grouping}.npy"), mmap_mode="r")
+        self.genes = np.load(os.path.join(folder, "genes.npy"))
+        self.group_info = pd.read_parquet(os.path.join(folder, f"summary_{grouping}_groups.parquet"))
+
+    # Get the summary of a gene as a dataframe with one row per group (raises KeyError if it is missing)
+    def gene(self, gene_name):
+        position = ExpressionStore._find(self.genes, [gene_name])[0]
+        summary = pd.DataFrame(self.values[position], columns=SUMMARY_STATISTICS)
+
+        return pd.concat([self.group_info, summary], axis=1)
+
+###################################################################################################
+
+# Class to find the genes most correlated with a gene across cell lines (built once per dataset/method)
+# Each gene profile is centered and scaled to unit length (after ranking it, for Spearman), so the 
+# correlations of one gene with all the others are a single matrix-vector product, and the top genes
+# are found by a partial sort. The values are kept as genes x cell lines float32 (one contiguous row
+# per gene). Missing values are replaced by the mean of their gene, so they do not add correlation.
+class CoexpressionIndex:
+
+    def __init__(self, values, genes, method="Pearson", block_size=1000):
+        self.genes = genes
+        self.values = np.array(values, dtype=np.float32, order="C")
+
+        # Process the genes in blocks, so the float64 copies made by pandas/numpy stay small
+        for start in range(0, len(self.values), block_size):
+            block = self.values[start:start + block_size]
+            if method == "Spearman":
+                block[:] = pd.DataFrame(block).rank(axis=1).to_numpy()
+            means = np.nanmean(block, axis=1, keepdims=True)
+            missing_rows, missing_columns = np.nonzero(np.isnan(block))
+            block[missing_rows, missing_columns] = means[missing_rows, 0]
+            block -= means
+            norms = np.linalg.norm(block, axis=1, keepdims=True)
+            np.divide(block, norms, out=block, where=norms > 0)
+
+    # Get the k genes most correlated with a gene (raises KeyError if it is missing)
+    def top(self, gene_name, k=COEXPRESSION_TOP_K):
+
+        position = ExpressionStore._find(self.genes, [gene_name])[0]
+        correlations = self.values @ self.values[position]
+        correlations[position] = -np.inf
+        k = min(k, len(correlations) - 1)
+        top_positions = np.argpartition(-correlations, k - 1)[:k]
+        top_positions = top_positions[np.argsort(-correlations[top_positions], kind="stable")]
+
+        return pd.DataFrame({"Gene": self.genes[top_positions], "Correlation": correlations[top_positions]})
+
+###################################################################################################
+
+# Class to find the cell lines with the most similar expression profiles (built once per dataset)
+# Each gene is centered on its mean across cell lines (otherwise all profiles look alike, dominated by
+# the housekeeping genes), then each profile is scaled to unit length, so the cosine similarities of all
+# the cell line pairs are one matrix product. That small cell lines x cell lines matrix is kept, and a
+# search is just reading one of its rows and a partial sort.
+class SimilarityIndex:
+
+    def __init__(self, expression_store, variable_genes=None):
+        self.cells = expression_store.cells
+        profiles = np.array(expression_store.values, dtype=np.float32)
+        means = np.nanmean(profiles, axis=0)
+
+        # Optionally keep only the genes that vary the most between cell lines
+        if variable_genes is not None and variable_genes < profiles.shape[1]:
+            keep = np.sort(np.argsort(np.nanvar(profiles, axis=0), kind="stable")[-variable_genes:])
+            profiles, means = profiles[:, keep], means[keep]
+
+        profiles -= means
+        np.nan_to_num(profiles, copy=False)
+        norms = np.linalg.norm(profiles, axis=1, keepdims=True)
+        np.divide(profiles, norms, out=profiles, where=norms > 0)
+        self.similarities = profiles @ profiles.T
+
+    # Get the k cell lines most similar to a cell line (raises KeyError if it is missing)
+    # The results can be limited to some cell lines (candidates), the others are left out before sorting
+    def top(self, cell_name, k=SIMILAR_CELLS_TOP_K, candidates=None):
+
+        position = ExpressionStore._find(self.cells, [cell_name])[0]
+        similarities = self.similarities[position].copy()
+        if candidates is not None:
+            similarities[~np.isin(self.cells, candidates)] = -np.inf
+        similarities[position] = -np.inf
+        k = min(k, int(np.isfinite(similarities).sum()))
+        if k == 0:
+            return pd.DataFrame({"Cell line": self.cells[:0], "Similarity": similarities[:0]})
+        top_positions = np.argpartition(-similarities, k - 1)[:k]
+        top_positions = top_positions[np.argsort(-similarities[top_positions], kind="stable")]
+
+        return pd.DataFrame({"Cell line": self.cells[top_positions], "Similarity": similarities[top_positions]})
+
+###################################################################################################
+
+# Function to adjust p-values for multiple testing (Benjamini-Hochberg), NaNs are kept and not counted
+def adjust_p_values(p_values):
+
+    q_values = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    order = tested[np.argsort(p_values[tested], kind="stable")]
+    ranked = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    q_values[order] = np.minimum.accumulate(ranked[::-1])[::-1].clip(max=1)
+
+    return q_values
+
+###################
+
+# Class to compare the expression of every gene between two groups of cell lines (Welch's t-test)
+# Each group is reduced to the count, sum and sum of squares of every gene, read from its rows of the
+# matrix at once, so all the genes are tested together. The sums of all the cell lines given (the named
+# ones of the menu in the app, all of them if not given) are computed once, so comparing a group against
+# all the other cell lines only reads the rows of that group.
+class DifferentialExpression:
+
+    def __init__(self, expression_store, cells=None):
+        self.expression_store = expression_store
+        self.positions = (np.arange(len(expression_store.cells)) if cells is None 
+                          else np.unique(expression_store.cell_positions(list(cells))))
+        self.totals = self.group_sums(self.positions)
+
+    # Count, sum and sum of squares of every gene (float64, to keep the variances accurate)
+    def group_sums(self, positions, block_size=500):
+        counts, sums, squares = (np.zeros(len(self.expression_store.genes)) for _ in range(3))
+        for start in range(0, len(positions), block_size):
+            values = np.take(self.expression_store.values, positions[start:start + block_size], axis=0).astype(np.float64)
+            counts += (~np.isnan(values)).sum(axis=0)
+            sums += np.nansum(values, axis=0)
+            squares += np.nansum(values**2, axis=0)
+        return counts, sums, squares
+
+    # Get a table of all the genes ranked by p-value. Group B is all the other cell lines if not given
+    # The cell lines of group A are always left out of group B, so the groups never overlap
+    def compare(self, cells_a, cells_b=None):
+
+        positions_a = np.unique(self.expression_store.cell_positions(list(cells_a)))
+        sums_a = self.group_sums(positions_a)
+        if cells_b is None:
+            positions_a_in_totals = np.intersect1d(positions_a, self.positions)
+            sums_a_in_totals = sums_a if len(positions_a_in_totals) == len(positions_a) else self.group_sums(positions_a_in_totals)
+            sums_b = tuple(total - group for total, group in zip(self.totals, sums_a_in_totals))
+        else:
+            sums_b = self.group_sums(np.setdiff1d(self.expression_store.cell_positions(list(cells_b)), positions_a))
+
+        # Means, variances and Welch's t-test (with the Welch-Satterthwaite degrees of freedom)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            (n_a, mean_a, variance_a), (n_b, mean_b, variance_b) = [
+                (n, sums / n, (squares - sums**2 / n).clip(min=0) / (n - 1)) for n, sums, squares in [sums_a, sums_b]]
+            standard_error_a, standard_error_b = variance_a / n_a, variance_b / n_b
+            t_statistics = (mean_a - mean_b) / np.sqrt(standard_error_a + standard_error_b)
+            degrees_of_freedom = (standard_error_a + standard_error_b)**2 / (
+                standard_error_a**2 / (n_a - 1) + standard_error_b**2 / (n_b - 1))
+        p_values = 2 * stats.t.sf(np.abs(t_statistics), degrees_of_freedom)
+
+        results = pd.DataFrame({"Gene": self.expression_store.genes, "Mean A": mean_a, "Mean B": mean_b,
+                                "Difference": mean_a - mean_b, "t": t_statistics, "p-value": p_values,
+                                "q-value": adjust_p_values(p_values)})
+
+        return results.sort_values("p-value", kind="stable", na_position="last").reset_index(drop=True)
+
+###################################################################################################
+
+# Function to read gene sets from an uploaded file, as a dict of set name: list of genes
+# GMT files have one set per line (name, description, genes separated by tabs), any other file is one
+# set named as the file, with the genes separated by new lines, commas, tabs or spaces
+def read_gene_sets(file_name, text):
+
+    if file_name.lower().endswith(".gmt"):
+        gene_sets = {}
+        for line in text.splitlines():
+            fields = [field.strip() for field in line.split("\t")]
+            if len(fields) > 2 and fields[0]:
+                gene_sets[fields[0]] = [gene for gene in fields[2:] if gene]
+        return gene_sets
+
+    genes = text.replace(",", " ").split()
+    return {os.path.splitext(file_name)[0]: genes} if genes else {}
+
+###################
+
+# Class to score many gene sets in every cell line at once (the matrix is built once per dataset and method)
+# The sets are turned into a sparse genes x sets membership matrix with 1/size weights, so the mean of
+# the set genes in every cell line is one sparse x dense product for all the sets together, either over
+# the z-scores of each gene across cell lines, or over the rank of each gene within each cell line 
+# (as a fraction: 0.5 is the expected score of random genes, 1 the most expressed ones).
+# Only the matrix of the method given is built, since each one is a full float32 copy of the dataset.
+class GeneSetScorer:
+
+    def __init__(self, expression_store, method="Mean z-score", block_size=200):
+        self.cells = expression_store.cells
+        self.n_genes = len(expression_store.genes)
+        self.gene_positions = {gene.upper(): position for position, gene in enumerate(expression_store.genes)}
+        self.method = method
+
+        # Z-scores of each gene across cell lines (missing values get 0, the mean)
+        if method == "Mean z-score":
+            self.values = np.array(expression_store.values, dtype=np.float32)
+            means, deviations = np.nanmean(self.values, axis=0), np.nanstd(self.values, axis=0)
+            self.values -= means
+            np.divide(self.values, deviations, out=self.values, where=deviations > 0)
+            np.nan_to_num(self.values, copy=False)
+
+        # Ranks of the genes within each cell line, in blocks of cell lines (missing values get 0.5)
+        else:
+            self.values = np.empty(expression_store.values.shape, dtype=np.float32)
+            for start in range(0, len(self.cells), block_size):
+                block = pd.DataFrame(expression_store.values[start:start + block_size])
+                self.values[start:start + block_size] = block.rank(axis=1, pct=True).fillna(0.5).to_numpy()
+
+    # Build the membership matrix of the sets, and count the genes of each set found in the dataset
+    def membership(self, gene_sets):
+        rows, columns, genes_found = [], [], []
+        for column, genes in enumerate(gene_sets.values()):
+            positions = sorted({self.gene_positions[gene.upper()] for gene in genes if gene.upper() in self.gene_positions})
+            rows += positions
+            columns += [column] * len(positions)
+            genes_found.append(len(positions))
+        weights = 1 / np.repeat(np.maximum(genes_found, 1), genes_found)
+        matrix = sparse.csr_matrix((weights, (rows, columns)), shape=(self.n_genes, len(gene_sets)), dtype=np.float32)
+
+        return matrix, genes_found
+
+    # Get the scores of all the sets as a cell lines x sets dataframe (sets without genes found get NaN)
+    def score(self, gene_sets):
+        matrix, genes_found = self.membership(gene_sets)
+        scores = np.asarray(matrix.T @ self.values.T).T
+        scores[:, np.array(genes_found) == 0] = np.nan
+
+        return pd.DataFrame(scores, index=pd.Index(self.cells, name="Cell line"), columns=list(gene_sets))
+
+###################################################################################################
+
+# Function to get the first principal components of a matrix (rows = samples) by randomized SVD
+# The centered matrix is multiplied by a few random vectors (and by itself a few times to separate the
+# top components), so only a thin matrix is decomposed instead of the full SVD of the matrix.
+def randomized_pca(values, n_components=2, oversampling=10, power_iterations=4, seed=0):
+
+    centered = np.nan_to_num(values - np.nanmean(values, axis=0), copy=False).astype(np.float32, copy=False)
+    random_vectors = np.random.default_rng(seed).standard_normal((centered.shape[1], n_components + oversampling), dtype=np.float32)
+    basis = np.linalg.qr(centered @ random_vectors)[0]
+    for _ in range(power_iterations):
+        basis = np.linalg.qr(centered.T @ basis)[0]
+        basis = np.linalg.qr(centered @ basis)[0]
+    small_u, singular_values, _ = np.linalg.svd(basis.T @ centered, full_matrices=False)
+
+    return (basis @ small_u[:, :n_components]) * singular_values[:n_components]
+
+###################
+
+# Function to get the 2-D map of the cell lines (first 2 principal components of their profiles)
+# It is computed once and saved in the snapshot folder, which is cleared when the source files change
+def load_embedding(expression_store):
+
+    embedding_file = os.path.join(expression_store.folder, "embedding.npy")
+    if not os.path.isfile(embedding_file):
+        temporary_file = os.path.join(expression_store.folder, "embedding.tmp.npy")
+        np.save(temporary_file, randomized_pca(np.array(expression_store.values, dtype=np.float32)).astype(np.float32))
+        os.replace(temporary_file, embedding_file)
+
+    return np.load(embedding_file)
+
+###################################################################################################
+
+# Function to get an order of the rows of a matrix that puts similar rows together (for heatmaps)
+# The rows are sorted by their position along the first principal component of the centered matrix,
+# which takes a few milliseconds even for hundreds of rows (a hierarchical clustering grows as n^2)
+def order_rows(values):
+
+    if values.shape[0] < 3:
+        return np.arange(values.shape[0])
+    centered = np.nan_to_num(values - np.nanmean(values, axis=1, keepdims=True))
+    first_component = np.linalg.svd(centered, full_matrices=False)[0][:, 0]
+
+    return np.argsort(first_component, kind="stable")
+
+###################
+
+# Function to reduce a matrix to max_rows rows at most, averaging groups of consecutive rows
+# Each group gets the label -first ... last (number of rows)-, so the heatmap still shows what it has
+def aggregate_rows(values, labels, max_rows):
+
+    if values.shape[0] <= max_rows:
+        return values, list(labels)
+    starts = np.array([group[0] for group in np.array_split(np.arange(values.shape[0]), max_rows)])
+    ends = np.append(starts[1:], values.shape[0]) - 1
+    sums = np.add.reduceat(np.nan_to_num(values), starts, axis=0)
+    counts = np.add.reduceat(~np.isnan(values), starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+    group_labels = [f"{labels[start]} ... {labels[end]} ({end - start + 1})" for start, end in zip(starts, ends)]
+
+    return means, group_labels
+
+###################################################################################################
+
+# Function to get the dataset of a release: downloads the missing source files, then loads the snapshot
+# made from them (or builds it first if the files are new or changed). Each stage is timed and logged.
+def load_release(release, report=lambda label: None, log_file=TIMING_LOG):
+
+    timer = StageTimer(f"load {release}", log_file, report)
+    files = RELEASES[release]
+    missing_sources = [source for source in ["rna", "cell_info"] if not os.path.isfile(files[f"{source}_file"])]
+    if missing_sources:
+
+        # Get the md5 checksum and size of each file to verify the download (from figshare if not written)
+        report("Checking the files to download...")
+        downloads = []
+        for source in missing_sources:
+            md5, size = figshare_file_info(files[f"{source}_url"], files["figshare_article"])
+            downloads.append((files[f"{source}_url"], files[f"{source}_file"], files[f"{source}_md5"] or md5, size))
+
+        report("Downloading files...")
+        download_files(downloads, report=report)
+        report("Files downloaded!")
+        timer.lap("Download files")
+    else:
+        report("Files found!")
+
+    # Reuse the pre-processed snapshot from a previous start, unless the source files changed
+    report("Checking for a pre-processed snapshot...")
+    source_hash = hash_source_files(files["rna_file"], files["cell_info_file"])
+    timer.lap("Hash source files")
+    snapshot = load_snapshot(source_hash, files["snapshot_folder"])
+    if snapshot is None:
+        build_snapshot(files["rna_file"], files["cell_info_file"], source_hash, files["snapshot_folder"], report=report, timer=timer)
+        snapshot = load_snapshot(source_hash, files["snapshot_folder"])
+    timer.lap("Open snapshot")
+
+    # Precompute the summaries per lineage and disease and the map of the cell lines (only the first time,
+    # they are saved with the snapshot)
+    for grouping in SUMMARY_GROUPINGS:
+        if not os.path.isfile(os.path.join(files["snapshot_folder"], f"summary_{grouping}.npy")):
+            build_summaries(*snapshot, grouping, report=report)
+            timer.lap(f"Summarize per {grouping}")
+    if not os.path.isfile(os.path.join(files["snapshot_folder"], "embedding.npy")):
+        report("Mapping the cell lines...")
+        load_embedding(snapshot[0])
+        timer.lap("Map the cell lines")
+    report(f"Snapshot loaded! ({timer.total_seconds():.1f} s)")
+
+    return snapshot
+
+###################
+
+# Function to get the value of a gene in a cell line for each release given (NaN if it is missing)
+def compare_releases(datasets, gene, cell_line):
+
+    values = {}
+    for release, (expression_store, _) in datasets.items():
+        try:
+            values[release] = expression_store.values[expression_store.cell_positions([cell_line])[0],
+                                                       expression_store.gene_positions([gene])[0]]
+        except KeyError:
+            values[release] = np.nan
+
+    return pd.DataFrame({"Release": list(values), "log2(TPM+1)": list(values.values())})
+
+###################
+
+# Class to keep the datasets of the releases in use, loaded lazily (on the first request) and bounded
+# to the most recently used ones, so memory does not grow with the number of releases available.
+# It is shared by all sessions (threads), so a release requested while it is being loaded waits for
+# that load instead of starting another one. A release can also be loaded in a background thread,
+# whose progress (one line per stage) any session can read while it waits.
+class ReleaseRegistry:
+
+    def __init__(self, max_loaded=MAX_LOADED_RELEASES):
+        self.max_loaded = max_loaded
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.release_locks = {release: threading.Lock() for release in RELEASES}
+        self.threads = {}
+        self.stages = {release: [] for release in RELEASES}
+        self.errors = {}
+
+    # Start loading a release in a background thread, unless it is loaded or already being loaded
+    def start_loading(self, release):
+
+        with self.lock:
+            if release in self.loaded or (release in self.threads and self.threads[release].is_alive()):
+                return
+            self.stages[release] = []
+            self.errors.pop(release, None)
+            self.threads[release] = threading.Thread(target=self._load_in_background, args=(release,), 
+                                                     name=f"Load DepMap {release}", daemon=True)
+            self.threads[release].start()
+
+    def _load_in_background(self, release):
+        try:
+            self.get(release, report=lambda label: self._add_stage(release, label))
+        except Exception as e:
+            with self.lock:
+                self.errors[release] = e
+
+    # Keep one line per stage: a label with the same text before the counter updates the last line
+    def _add_stage(self, release, label):
+        with self.lock:
+            stages = self.stages[release]
+            if stages and stages[-1].split(" (")[0] == label.split(" (")[0]:
+                stages[-1] = label
+            else:
+                stages.append(label)
+
+    # Get whether a release is loaded, the stages of its load so far and the error that stopped it (if any)
+    def loading_status(self, release):
+        with self.lock:
+            return release in self.loaded, list(self.stages[release]), self.errors.get(release)
+
+    # Get the (expression store, cell menu) of a release, loading it first if needed
+    def get(self, release, report=lambda label: None):
+
+        with self.release_locks[release]:
+            with self.lock:
+                if release in self.loaded:
+                    self.loaded.move_to_end(release)
+                    return self.loaded[release]
+
+            dataset = load_release(release, report)
+
+            # Drop the least recently used releases (sessions only keep small extracted frames)
+            with self.lock:
+                self.loaded[release] = dataset
+                while len(self.loaded) > self.max_loaded:
+                    self.loaded.popitem(last=False)
+
+        return dataset
+
+    # Get the releases that are currently loaded, without loading anything
+    def loaded_releases(self):
+        with self.lock:
+            return dict(self.loaded)
+
+###################################################################################################
@@ -0,0 +1,131 @@
+'''
+App made by:
+    Eduardo Reyes Alvarez, Ph.D.
+Contact:
+    eduardo_reyes09@hotmail.com
+
+Script description:
+    Command line version of the extraction done by the app 001_RNA_expression_DepMap, for pipelines
+    that need the same data without a browser. It uses the same code as the app (depmap_data): the
+    files of the release are downloaded and pre-processed only if needed (the snapshot is shared with
+    the app when it runs in the same folder), then the expression of the cell lines and genes given
+    is written as a file (genes as rows, cell lines as columns, as the files downloaded from the app).
+    Cell lines can be given by name or by DepMap ID (ACH-...), and genes by symbol (all if not given).
+
+    Many queries can be answered with one load of the matrix by giving a csv file with the columns
+    "query", "cell_lines" and "genes" (names separated by ";", genes can be empty for all of them).
+    The results of all the queries are written as one long table (query, Gene, Cell line, value).
+
+Usage:
+    python depmap_extract.py --cells "HEK TE 293 T" ACH-000001 --genes TP53 EGFR --output results.parquet
+    python depmap_extract.py --batch queries.csv --output results.csv.gz
+
+'''
+###################################################################################################
+
+# Import the required libraries
+
+import os
+import sys
+import argparse
+import numpy as np
+import pandas as pd
+
+import depmap_data
+
+# File extensions accepted for the output and the format used to write them
+OUTPUT_FORMATS = {".xlsx": "xlsx", ".csv.gz": "csv.gz", ".csv": "csv", ".parquet": "parquet"}
+
+###################################################################################################
+
+# Function to get the dataset of a release, the same way the app does (download/build only if needed)
+def load_dataset(release=depmap_data.DEFAULT_RELEASE, verbose=True):
+    report = (lambda label: print(label, file=sys.stderr)) if verbose else (lambda label: None)
+    return depmap_data.load_release(release, report=report)
+
+###################
+
+# Function to get the genes x cell lines dataframe of one query (all the genes if none are given)
+def extract(expression_store, cell_menu, cell_lines, genes=None):
+    return expression_store.extract(depmap_data.resolve_cell_lines(cell_menu, cell_lines), genes or None)
+
+###################
+
+# Function to answer many queries with the same loaded matrix, as one long table
+# The columns of all the queries are collected as arrays and the table is made once at the end, which
+# is much faster than making (and melting) one dataframe per query.
+# Queries with names missing in the dataset are skipped and reported, the other ones are kept
+def extract_batch(expression_store, cell_menu, queries):
+
+    query_names, genes_column, cells_column, values_column, errors = [], [], [], [], {}
+    for query in queries.itertuples(index=False):
+        cell_lines = [name.strip() for name in str(query.cell_lines).split(";") if name.strip()]
+        genes = [name.strip() for name in str(query.genes).split(";") if name.strip()] if pd.notna(query.genes) else []
+        try:
+            result = extract(expression_store, cell_menu, cell_lines, genes)
+        except KeyError as e:
+            errors[query.query] = str(e)
+            continue
+
+        # One row per cell line and gene, cell line by cell line (as pandas melt does)
+        n_genes, n_cells = result.shape
+        query_names.append(np.full(n_genes * n_cells, query.query, dtype=object))
+        genes_column.append(np.tile(result.index.to_numpy(dtype=str), n_cells))
+        cells_column.append(np.repeat(result.columns.to_numpy(dtype=str), n_genes))
+        values_column.append(result.to_numpy().T.ravel())
+
+    columns = ["query", "Gene", "Cell line", "log2(TPM+1)"]
+    if not values_column:
+        return pd.DataFrame(columns=columns), errors
+    results = pd.DataFrame(dict(zip(columns, [np.concatenate(column) for column in 
+                                              [query_names, genes_column, cells_column, values_column]])))
+    return results, errors
+
+###################
+
+# Function to write a dataframe with the format given by the extension of the output file
+def write_output(dataframe, output_file):
+
+    extension = next((extension for extension in OUTPUT_FORMATS if output_file.lower().endswith(extension)), None)
+    if extension is None:
+        raise ValueError(f"The output file must end with one of: {', '.join(OUTPUT_FORMATS)}")
+    with open(output_file, "wb") as f:
+        f.write(depmap_data.export_frame(dataframe, OUTPUT_FORMATS[extension]).getbuffer())
+
+###################################################################################################
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Extract RNASeq data of DepMap cell lines without the app.")
+    parser.add_argument("--release", default=depmap_data.DEFAULT_RELEASE, choices=list(depmap_data.RELEASES), help="DepMap release")
+    parser.add_argument("--folder", default=".", help="Folder with the downloaded files and snapshot (created if needed)")
+    parser.add_argument("--cells", nargs="+", default=[], help="Cell line names or DepMap IDs")
+    parser.add_argument("--genes", nargs="+", default=[], help="Gene symbols (all genes if not given)")
+    parser.add_argument("--batch", help="csv file with the columns query, cell_lines and genes (names separated by ;)")
+    parser.add_argument("--output", required=True, help="Output file (.parquet, .csv, .csv.gz or .xlsx)")
+    parser.add_argument("--quiet", action="store_true", help="Do not print the loading progress")
+    args = parser.parse_args()
+    if not args.batch and not args.cells:
+        parser.error("Give the cell lines with --cells, or a csv of queries with --batch")
+
+    # The files of the release are found (or downloaded) relative to the folder, as in the app
+    output_file = os.path.abspath(args.output)
+    batch_file = os.path.abspath(args.batch) if args.batch else None
+    os.makedirs(args.folder, exist_ok=True)
+    os.chdir(args.folder)
+    expression_store, cell_menu = load_dataset(args.release, verbose=not args.quiet)
+
+    if batch_file:
+        queries = pd.read_csv(batch_file, dtype=str)
+        results, errors = extract_batch(expression_store, cell_menu, queries)
+        for query, error in errors.items():
+            print(f"Query {query} skipped. {error}", file=sys.stderr)
+        print(f"{len(queries) - len(errors)} of {len(queries)} queries extracted.", file=sys.stderr)
+    else:
+        try:
+            results = extract(expression_store, cell_menu, args.cells, args.genes).reset_index(drop=False)
+        except KeyError as e:
+            sys.exit(str(e))
+    write_output(results, output_file)
+
+###################################################################################################
@@ -14,24 +14,28 @@ App version:
 # Import required libraries
 
 import os
-import glob
+import hashlib
+import itertools
+import queue
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from zipfile import ZipFile
 import urllib.request
 import pandas as pd
-import time
 import streamlit as st
 from streamlit_option_menu import option_menu
 
-# Python-pptx specific modules
+# The presentations are made by this module (python-pptx code) in separate processes
+import deck_builder
 
-# To make the presentation
-from pptx import Presentation
-# To specify sizes of images and text (Other options like inches are available)
-from pptx.util import Cm, Pt            
-# To specify text alignment (the method is used on the text frame, not on the box or the actual text)
-from pptx.enum.text import PP_ALIGN     
-# To work with line and fill colours
-from pptx.enum.dml import MSO_THEME_COLOR
+# Number of processed zip files (with the approach used) kept in the cache
+MAX_CACHED_ZIPFILES = 10
+
+# Maximum number of cells/ROIs (pairs of images) in each slide
+IMAGES_PER_SLIDE = 20
+
+# Maximum number of processes started to downsample the images and make the presentations
+MAX_WORKERS = 4
 
 ###################################################################################################
 
@@ -70,108 +74,91 @@ def change_pages():
 
 ###################################################################################################
 
-# Function to process the input files
+# Function to get a hash of the content of the uploaded zip file (read in blocks, not at once)
+# It identifies the data in the cache, so a different file is never served the slides of another one
 
-@st.cache_data(show_spinner=False)
-def process_files(T_and_FM):
+def hash_zipfile(zip_file, block_size=2**20):
 
-    # Extract all the folder structure and files of the zip file provided by the user
-    with ZipFile(st.session_state["data_zipfile"], 'r') as zip:
-        zip.extractall()
+    zip_hash = hashlib.sha256()
+    zip_file.seek(0)
+    for block in iter(lambda: zip_file.read(block_size), b""):
+        zip_hash.update(block)
+    zip_file.seek(0)
 
-    # The unzipping takes several seconds, so we wait for the folder to appear
-    while not "Data" in os.listdir():
-        time.sleep(1)
+    return zip_hash.hexdigest()
 
-    # Walk through the Data folder to find all csv files
-    data_folder = os.path.join(st.session_state["current_directory"], "Data")
-    extension_wanted = "*.csv"
-    all_csv_files = [file
-                    for path, subdir, files in os.walk(data_folder)
-                    for file in glob.glob(os.path.join(path, extension_wanted))]
+###################################################################################################
 
-    # Make list with names and paths of the experimental conditions (according to the number of csv files found above)
-    exp_conditions_info = []
-    
-    for csv_file in all_csv_files:
-        csv_root_folder = os.path.normpath(csv_file).split(os.path.sep + "Data" + os.path.sep)[1].split(os.path.sep + "Quantification")[0]
-        exp_conditions_info.append([csv_root_folder, csv_file])
+# Function to process the input files
+# The zip file is not hashed by streamlit (underscore), its content hash and the approach used are the
+# cache key instead. Only the most recent files are kept in the cache (the oldest ones are removed).
 
-    # We will store all the information of the images to insert to the ppt here
-    all_info_for_slides = []
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_ZIPFILES)
+def process_files(_zip_file, zip_hash, T_and_FM):
 
-    # Iterate for each folder contained in the Data folder uploaded
-    for condition_info in exp_conditions_info:
-        
-        # Read the csv file for the current experimental condition
-        results_table = pd.read_csv(condition_info[1])
-
-        # Make some edits for easier manipulation and sorting of the subtitles, folders and ROI names
-        results_table["Image used"] = results_table["Image used"].str.replace("MAX_","")
-        results_table["Image used"] = results_table["Image used"].str.replace(".tif","")
-        results_table["Cell quantified"] = results_table["Cell quantified"].str.replace("_1.roi","")
-        results_table["Cell quantified"] = results_table["Cell quantified"].apply(int)
-        if T_and_FM == "Both" or T_and_FM == "Thresholding only":
-            results_table["Particle count threshold"] = results_table["Particle count threshold"].apply(int)
-        if T_and_FM == "Both" or T_and_FM == "Find Maxima only":
-            results_table["Particle count maxima"] = results_table["Particle count maxima"].apply(int)
-        results_table = results_table.sort_values(by=["Image used", "Cell quantified"],ignore_index=True)
-
-        # Iterate through the rows of the csv file (ROIs/cells quantified)
-        for _,row in results_table.iterrows():
-            
-            # Retrieve all the relevant information for that row
-            ROI_title = condition_info[0]
-            ROI_subtitle = row["Image used"]
-            ROI_name = str(row["Cell quantified"])
-            ROI_Fluorescence_image = condition_info[1].replace(os.path.join("Quantification", "Results.csv"), 
-                                        os.path.join("Cropped cells", "Fluorescence", ROI_subtitle, ROI_name+"_2.jpg"))
-            # For now the image and counts will be set to None when only one approach is used (new feature)
-            # This allows us to use the same code in the function that makes the slides 
-            if T_and_FM == "Thresholding only":
-                ROI_Tcount_image = ROI_Fluorescence_image.replace("Fluorescence", "T_Particles").replace("_2.jpg", "_1.jpg")
-                ROI_Tcount = row["Particle count threshold"]
-                ROI_FMcount_image = None
-                ROI_FMcount = None
-            elif T_and_FM == "Find Maxima only":
-                ROI_Tcount_image = None
-                ROI_Tcount = None
-                ROI_FMcount_image = ROI_Fluorescence_image.replace("Fluorescence", "FM_Particles").replace("_2.jpg", "_1.jpg")
-                ROI_FMcount = row["Particle count maxima"]
-            else:
-                ROI_Tcount_image = ROI_Fluorescence_image.replace("Fluorescence", "T_Particles").replace("_2.jpg", "_1.jpg")
-                ROI_Tcount = row["Particle count threshold"]
-                ROI_FMcount_image = ROI_Fluorescence_image.replace("Fluorescence", "FM_Particles").replace("_2.jpg", "_1.jpg")
-                ROI_FMcount = row["Particle count maxima"]
-
-            all_info_for_slides.append([ROI_title, ROI_subtitle, ROI_Fluorescence_image, ROI_name, ROI_Tcount_image, ROI_Tcount, ROI_FMcount_image, ROI_FMcount])
-
-    # Prepare empty variables to store the grouped images for each slide
-    all_slides_content = []
-    temp_slide = []
-
-    # Retrieve the title and subtitle of the very first image to feed the loop at i=0
-    current_title = all_info_for_slides[0][0]
-    current_subtitle = all_info_for_slides[0][1]
-
-    # Iterate through all the information retrieve for each cell/ROI
-    for info in all_info_for_slides:
-        
-        # Get the current title and subtitle to compare to the reference
-        new_title = info[0]
-        new_subtitle = info[1]
+    # Read the list of files from the zip file provided by the user (its central directory), without
+    # extracting anything to disk. The names inside a zip always use "/" as separator.
+    with ZipFile(_zip_file, 'r') as zip_archive:
 
-        # Check the 3 conditions described in text above
-        if len(temp_slide)==20 or new_title!=current_title or new_subtitle!=current_subtitle:
-            
-            # If anything triggers the change of slide, dump the current, empty it and set titles as refs
-            all_slides_content.append(temp_slide)
-            temp_slide = []
-            current_title = new_title
-            current_subtitle = new_subtitle
+        # Find all csv files inside the Data folder (sorted so the conditions always have the same order)
+        all_csv_files = sorted(name for name in zip_archive.namelist()
+                               if name.startswith("Data/") and name.lower().endswith(".csv"))
+
+        # Read the csv files as streams from the zip (since the archive is already open), and put all of
+        # them together in one table, noting the experimental condition (and its folder) of each row
+        results_tables = []
         
-        # Always attach the cell/ROI, could be at the same group/slide with others, or to a empty temp slide
-        temp_slide.append(info)
+        for condition_number, csv_file in enumerate(all_csv_files):
+            results_table = pd.read_csv(zip_archive.open(csv_file))
+            results_table["Condition number"] = condition_number
+            results_table["Condition"] = csv_file.split("Data/", 1)[1].split("/Quantification")[0]
+            results_table["Condition folder"] = csv_file.replace("Quantification/Results.csv", "")
+            results_tables.append(results_table)
+
+    if not results_tables:
+        return []
+    manifest = pd.concat(results_tables, ignore_index=True)
+
+    # Make some edits for easier manipulation and sorting of the subtitles, folders and ROI names
+    # All the rows (ROIs/cells quantified) of all the conditions are edited at once, column by column
+    manifest["Image used"] = manifest["Image used"].str.replace("MAX_","").str.replace(".tif","")
+    manifest["Cell quantified"] = manifest["Cell quantified"].str.replace("_1.roi","").astype(int)
+    manifest = manifest.sort_values(by=["Condition number", "Image used", "Cell quantified"], ignore_index=True)
+    manifest["ROI name"] = manifest["Cell quantified"].astype(str)
+
+    # Make the paths of the images inside the zip from the folder of the condition, subtitle and ROI name
+    image_folders = manifest["Condition folder"] + "Cropped cells/"
+    image_names = "/" + manifest["Image used"] + "/" + manifest["ROI name"]
+    manifest["Fluorescence image"] = image_folders + "Fluorescence" + image_names + "_2.jpg"
+
+    # The image and counts are set to None for the approach that was not used
+    # This allows us to use the same code in the function that makes the slides 
+    if T_and_FM == "Both" or T_and_FM == "Thresholding only":
+        manifest["T image"] = image_folders + "T_Particles" + image_names + "_1.jpg"
+        manifest["T count"] = manifest["Particle count threshold"].astype(int)
+    else:
+        manifest["T image"] = None
+        manifest["T count"] = None
+    if T_and_FM == "Both" or T_and_FM == "Find Maxima only":
+        manifest["FM image"] = image_folders + "FM_Particles" + image_names + "_1.jpg"
+        manifest["FM count"] = manifest["Particle count maxima"].astype(int)
+    else:
+        manifest["FM image"] = None
+        manifest["FM count"] = None
+
+    # Group the ROIs by slide: a new slide starts when the title (condition) or subtitle (image) changes,
+    # or when a slide already has 20 images. The ROIs of each image are numbered in order (cumcount), and
+    # every 20 of them go to the next slide of that image. The slides are numbered in the sorted order.
+    slide_in_image = manifest.groupby(["Condition number", "Image used"]).cumcount() // IMAGES_PER_SLIDE
+    manifest["Slide"] = manifest.groupby(["Condition number", "Image used", slide_in_image], sort=False).ngroup()
+
+    # Convert the table to the info for each cell/ROI that the slide maker uses, grouped by slide
+    # (the rows of each slide are together since the table is sorted)
+    all_info_for_slides = manifest[["Condition", "Image used", "Fluorescence image", "ROI name", 
+                                    "T image", "T count", "FM image", "FM count"]].to_numpy(dtype=object).tolist()
+    slide_sizes = manifest.groupby("Slide").size().tolist()
+    all_slides_content = [all_info_for_slides[slide_end - slide_size:slide_end] 
+                          for slide_size, slide_end in zip(slide_sizes, itertools.accumulate(slide_sizes))]
 
     return all_slides_content
 
@@ -179,205 +166,88 @@ def process_files(T_and_FM):
 
 # Function to generate the presentations and pass the slide maker the content it should insert 
 
-def generate_pptxs(all_slides_content, T_and_FM):
+def generate_pptxs(all_slides_content, T_and_FM, zip_data, image_dpi):
 
     # This function makes a presentation for the Thresholding and Find Maxima approaches
     # If only one approach was used, this function will make only one presentation
+    # Each presentation is made in its own process (so both are made at the same time), and they send
+    # their progress through a queue to update the progress bars. They are kept in memory (as bytes).
 
     st.markdown('<hr style="margin-top: +10px; margin-bottom: +10px;">', unsafe_allow_html=True)
+    images_progress = st.progress(0, text='Preparing images...')
     col_1_row_3, col_2_row_3= st.columns([1, 1], gap="medium")
 
-    # Check if we need to generate a presentation for the Thresholding approach
+    # Presentations to make: name, columns of the particle images and counts, where to show the progress
+    decks = []
     if T_and_FM == "Both" or T_and_FM == "Thresholding only":
-
-        # Open the presentation uploaded by the user
-        presentation_T = Presentation(st.session_state["template_pptx"])
-
-        # Initialize the progress bar
-        with col_1_row_3:
-            T_progress = st.progress(0, text='Making Thresholding presentation...')
-
-        # Iterate through the image info grouped by slide
-        for i,slide_content in enumerate(all_slides_content):
-
-            # Prepare the parameters we need to pass to the function that makes the slides
-            current_slide_title = slide_content[0][0]
-            current_slide_subtitle = slide_content[0][1]
-            image_count_for_slide = len(slide_content)
-            F_images_for_slide = [image[2] for image in slide_content]
-            F_images_labels = [image[3] for image in slide_content]
-            P_images_for_slide = [image[4] for image in slide_content]
-            P_images_labels = [image[5] for image in slide_content]
-
-            # Feed the function that makes the slide and inserts the corresponding images
-            presentation_T = slide_maker(presentation_T, current_slide_title, current_slide_subtitle, image_count_for_slide, 
-                                        F_images_for_slide, P_images_for_slide, F_images_labels, P_images_labels)
-
-            # Update the progress bar
-            with col_1_row_3:
-                T_progress.progress((i+1)/len(all_slides_content), text=f'Making Thresholding presentation (slide {i+1} of {len(all_slides_content)})')
-
-        # Finally, save this summary presentation after all slides have been created
-        presentation_T.save(os.path.join(st.session_state["current_directory"], "Summary_results_T.pptx"))
-
-    #####
-
-    # Check if we need to generate a presentation for the Find Maxima approach
+        decks.append(["T", 4, 5, col_1_row_3, "Thresholding"])
     if T_and_FM == "Both" or T_and_FM == "Find Maxima only":
-
-        # Open the presentation uploaded by the user
-        presentation_FM = Presentation(st.session_state["template_pptx"])
-        
-        # Initialize the progress bar
-        with col_2_row_3:
-            FM_progress = st.progress(0, text='Making Find Maxima presentation...')
-
-        # Iterate through the image info grouped by slide
-        for i,slide_content in enumerate(all_slides_content):
-
-            # Prepare the parameters we need to pass to the function that makes the slides
-            current_slide_title = slide_content[0][0]
-            current_slide_subtitle = slide_content[0][1]
-            image_count_for_slide = len(slide_content)
-            F_images_for_slide = [image[2] for image in slide_content]
-            F_images_labels = [image[3] for image in slide_content]
-            P_images_for_slide = [image[6] for image in slide_content]
-            P_images_labels = [image[7] for image in slide_content]
-            
-            # Feed the function
-            presentation_FM = slide_maker(presentation_FM, current_slide_title, current_slide_subtitle, image_count_for_slide, 
-                                        F_images_for_slide, P_images_for_slide, F_images_labels, P_images_labels)
-
-            # Update the progress bar
-            with col_2_row_3:
-                FM_progress.progress((i+1)/len(all_slides_content), text=f'Making Find Maxima presentation (slide {i+1} of {len(all_slides_content)})')
-
-        # Finally, save this summary presentation after all slides have been created
-        presentation_FM.save(os.path.join(st.session_state["current_directory"], "Summary_results_FM.pptx"))
-
-###################################################################################################
-
-# Function to add slides to a pptx and inserts images+text 
-
-def slide_maker(presentation_input, current_slide_title, current_slide_subtitle, image_count_for_slide, 
-                F_images_for_slide, P_images_for_slide, F_images_labels, P_images_labels):
-
-    # All coordinates are stated always in the same order: From left first, from top second.
-
-    # Title text box dimensions and coordinates (centimeters) 
-    title_width = 17
-    title_height = 1.5
-    title_left_coordinate = 0
-    title_top_coordinate = 0
-    
-    # Subtitle text box dimensions and coordinates (centimeters)
-    subtitle_width = 17
-    subtitle_height = 1.5
-    subtitle_left_coordinate = 17
-    subtitle_top_coordinate = 0
-    
-    # Size and coordinates for the 20 pairs of images (centimeters)
-    image_width = 3.25
-    image_height = 3
-    image_coordinates = [
-    (0.25, 2.1, 3.5, 2.1),   (7, 2.1, 10.25, 2.1),   (13.75 , 2.1, 17, 2.1),  (20.5, 2.1, 23.75, 2.1),    (27.25, 2.1, 30.5, 2.1),
-    (0.25, 6.4, 3.5, 6.4),   (7, 6.4, 10.25, 6.4),   (13.75, 6.4, 17, 6.4),   (20.5, 6.4, 23.75, 6.4),    (27.25, 6.4, 30.5, 6.4),
-    (0.25, 10.7, 3.5, 10.7), (7, 10.7, 10.25, 10.7), (13.75, 10.7, 17, 10.7), (20.5, 10.7, 23.75, 10.7),  (27.25, 10.7, 30.5, 10.7),
-    (0.25, 15, 3.5, 15),     (7, 15, 10.25, 15),     (13.75, 15, 17, 15),     (20.5, 15, 23.75, 15),      (27.25, 15, 30.5, 15)
-    ]
-    
-    # Size and coordinates for the 20 pairs of text labels (centimeters) (+3cm top coordinate of images)
-    image_labels_width = 3.25
-    image_labels_height = 1
-    image_labels_coordinates = [
-    (0.25, 5.1, 3.5, 5.1),   (7, 5.1, 10.25, 5.1),   (13.75 , 5.1, 17, 5.1),  (20.5, 5.1, 23.75, 5.1),    (27.25, 5.1, 30.5, 5.1),
-    (0.25, 9.4, 3.5, 9.4),   (7, 9.4, 10.25, 9.4),   (13.75, 9.4, 17, 9.4),   (20.5, 9.4, 23.75, 9.4),    (27.25, 9.4, 30.5, 9.4),
-    (0.25, 13.7, 3.5, 13.7), (7, 13.7, 10.25, 13.7), (13.75, 13.7, 17, 13.7), (20.5, 13.7, 23.75, 13.7),  (27.25, 13.7, 30.5, 13.7),
-    (0.25, 18, 3.5, 18),     (7, 18, 10.25, 18),     (13.75, 18, 17, 18),     (20.5, 18, 23.75, 18),      (27.25, 18, 30.5, 18)
-    ]
-    
-    # Create a new slide (layout Blank)
-    blank_slide_layout = presentation_input.slide_layouts[6]
-    slide = presentation_input.slides.add_slide(blank_slide_layout)
-    
-    # Make the title for this experimental condition
-    left = Cm(title_left_coordinate)
-    top = Cm(title_top_coordinate)
-    width = Cm(title_width)
-    height = Cm(title_height)
-    title_textbox = slide.shapes.add_textbox(left, top, width, height)
-    title_frame = title_textbox.text_frame
-    title_text = title_frame.paragraphs[0]
-    title_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-    title_text.text = current_slide_title
-    title_text.font.bold = True
-    title_text.font.size = Pt(32)
-    title_text.font.name = "Times New Roman"
-    
-    # Make the subtitle for the image where the ROI was cropped from
-    left = Cm(subtitle_left_coordinate)
-    top = Cm(subtitle_top_coordinate)
-    width = Cm(subtitle_width)
-    height = Cm(subtitle_height)
-    subtitle_textbox = slide.shapes.add_textbox(left, top, width, height)
-    subtitle_frame = subtitle_textbox.text_frame
-    subtitle_text = subtitle_frame.paragraphs[0]
-    subtitle_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-    subtitle_text.text = current_slide_subtitle
-    subtitle_text.font.size = Pt(32)
-    subtitle_text.font.name = "Times New Roman"
-    
-    # Based on the number of images for the current slide, retrieve the neccesary images and coordinates
-    for i in range(image_count_for_slide):
-        
-        # Find the images to insert
-        fluorescence_image = F_images_for_slide[i]
-        particle_image = P_images_for_slide[i]
-        
-        # Insert the cropped cell from the Fluorescence folder first
-        left = Cm(image_coordinates[i][0])
-        top = Cm(image_coordinates[i][1])
-        width = Cm(image_width)
-        height = Cm(image_height)
-        inserting_image = slide.shapes.add_picture(fluorescence_image, left, top, width, height)
-        
-        # Insert the text label corresponding to the image just inserted above
-        left = Cm(image_labels_coordinates[i][0])
-        top = Cm(image_labels_coordinates[i][1])
-        width = Cm(image_labels_width)
-        height = Cm(image_labels_height)
-        inserting_image_textbox = slide.shapes.add_textbox(left, top, width, height)
-        inserting_image_frame = inserting_image_textbox.text_frame
-        inserting_image_text = inserting_image_frame.paragraphs[0]
-        inserting_image_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-        inserting_image_text.text = F_images_labels[i]
-        inserting_image_text.font.size = Pt(20)
-        inserting_image_text.font.name = "Times New Roman"
-        
-        # Insert the cropped cell from the Particles folder second (FM or T particles)
-        left = Cm(image_coordinates[i][2])
-        top = Cm(image_coordinates[i][3])
-        width = Cm(image_width)
-        height = Cm(image_height)
-        inserting_image2 = slide.shapes.add_picture(particle_image, left, top, width, height)
-        inserting_image2.line.fill.solid()
-        inserting_image2.line.width = Pt(0.5)
-        inserting_image2.line.fill.fore_color.theme_color = MSO_THEME_COLOR.ACCENT_1
-    
-        # Insert the text label corresponding to the particle counts just inserted above
-        left = Cm(image_labels_coordinates[i][2])
-        top = Cm(image_labels_coordinates[i][3])
-        width = Cm(image_labels_width)
-        height = Cm(image_labels_height)
-        inserting_image2_textbox = slide.shapes.add_textbox(left, top, width, height)
-        inserting_image2_frame = inserting_image2_textbox.text_frame
-        inserting_image2_text = inserting_image2_frame.paragraphs[0]
-        inserting_image2_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
-        inserting_image2_text.text = "P="+str(P_images_labels[i])
-        inserting_image2_text.font.size = Pt(20)
-        inserting_image2_text.font.name = "Times New Roman"
-    
-    return presentation_input
+        decks.append(["FM", 6, 7, col_2_row_3, "Find Maxima"])
+
+    # Initialize the progress bars
+    progress_bars = {}
+    for deck, _, _, column, approach in decks:
+        with column:
+            progress_bars[deck] = st.progress(0, text=f'Making {approach} presentation...')
+    approaches = {deck[0]: deck[4] for deck in decks}
+
+    # Images used by each presentation (the fluorescence images are shared by both presentations)
+    deck_image_names = {deck: list(dict.fromkeys(image[column] for slide_content in all_slides_content 
+                                                 for image in slide_content for column in [2, images_column]))
+                        for deck, images_column, _, _, _ in decks}
+
+    # Read once all the images used from the zip file (without decoding them)
+    raw_images = deck_builder.read_images(zip_data, dict.fromkeys(itertools.chain(*deck_image_names.values())))
+    original_sizes = {image_name: len(image_data) for image_name, image_data in raw_images.items()}
+    image_groups = list(raw_images.items())
+    image_groups = [dict(image_groups[start:start + deck_builder.IMAGES_PER_TASK]) 
+                    for start in range(0, len(image_groups), deck_builder.IMAGES_PER_TASK)]
+    del raw_images
+
+    # Start the processes (spawned, so they do not copy the memory of the app), one per presentation and 
+    # at most one per CPU available to the app (sched_getaffinity is not available on Windows and macOS)
+    spawn_context = multiprocessing.get_context("spawn")
+    available_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    max_workers = max(len(decks), min(available_cpus, MAX_WORKERS))
+    with spawn_context.Manager() as manager, ProcessPoolExecutor(max_workers=max_workers, mp_context=spawn_context) as executor:
+
+        # Downsample the images in groups, using all the processes
+        images = {}
+        image_futures = [executor.submit(deck_builder.downsample_images, image_group, image_dpi) for image_group in image_groups]
+        for future in as_completed(image_futures):
+            images.update(future.result())
+            images_progress.progress(len(images)/len(original_sizes), 
+                                     text=f'Preparing images ({len(images)} of {len(original_sizes)})')
+        del image_groups
+
+        # Make the presentations, each process gets only the images of its own presentation
+        progress_queue = manager.Queue()
+        futures = {deck: executor.submit(deck_builder.build_presentation, st.session_state["template_pptx"], 
+                                         {image_name: images[image_name] for image_name in deck_image_names[deck]}, 
+                                         all_slides_content, images_column, counts_column, deck, progress_queue)
+                   for deck, images_column, counts_column, _, _ in decks}
+
+        # Update the progress bars until both presentations are finished and all the progress was shown
+        while not all(future.done() for future in futures.values()) or not progress_queue.empty():
+            try:
+                deck, slides_done, total_slides = progress_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            progress_bars[deck].progress(slides_done/total_slides, 
+                                         text=f'Making {approaches[deck]} presentation (slide {slides_done} of {total_slides})')
+
+        # Get the presentations made (an error in a process is raised here)
+        for deck, future in futures.items():
+            st.session_state["pptx_" + deck] = future.result()
+
+    # Report the size of the images inserted in each presentation, compared to the original images
+    images_report = []
+    for deck, _, _, _, approach in decks:
+        original_MB = sum(original_sizes[image_name] for image_name in deck_image_names[deck]) / 2**20
+        downsampled_MB = sum(len(images[image_name]) for image_name in deck_image_names[deck]) / 2**20
+        images_report.append(f"{approach} presentation: images reduced from {original_MB:.1f} MB to "
+                             f"{downsampled_MB:.1f} MB at {image_dpi} DPI ({original_MB - downsampled_MB:.1f} MB saved).")
+    st.session_state["images_report"] = images_report
 
 ###################################################################################################
 
@@ -399,6 +269,8 @@ def load_first_page():
         T_and_FM = st.radio(label="Quantification approach used:", 
                             options=["Both","Thresholding only", "Find Maxima only"],
                             index=0,)
+        image_dpi = st.number_input(label="Image resolution (DPI):", min_value=50, max_value=600, 
+                                    value=deck_builder.IMAGE_DPI, step=50)
 
     # Display a button so the user decides when to start (in case uploaded the incorrect file)
     with col_1_row_2:
@@ -407,39 +279,45 @@ def load_first_page():
     # Proceed only when the button to start is pressed and a compressed file has been uploaded
     if st.session_state["start_button"] and uploaded_file:
         
-        # Initialize the progress tracker
-        with open(uploaded_file.name, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        st.session_state["data_zipfile"] = os.path.join(os.path.dirname(os.path.abspath(uploaded_file.name)), "Data.zip")
+        # Keep the uploaded file in memory (it is already a stream), the zip is read from there
+        st.session_state["data_zipfile"] = uploaded_file
+        st.session_state["data_zipfile_hash"] = hash_zipfile(uploaded_file)
+
+        # Remove the presentations of a previous run, so only the ones made now can be downloaded
+        st.session_state.pop("pptx_T", None)
+        st.session_state.pop("pptx_FM", None)
+        st.session_state.pop("images_report", None)
 
         # Process the files to extract the information needed to import to the slide generator
-        all_slides_content = process_files(T_and_FM)
-        generate_pptxs(all_slides_content, T_and_FM)
-        
-        # Check if we need to prepare the path for the Thresholding presentation
-        if T_and_FM == "Both" or T_and_FM == "Thresholding only":
-            threholding_file_path = os.path.join(st.session_state["current_directory"], "Summary_results_T.pptx")
-            st.session_state["path1"] = threholding_file_path
-
-        # Check if we need to prepare the path for the Find Maxima presentation
-        if T_and_FM == "Both" or T_and_FM == "Find Maxima only":    
-            find_maxima_file_path = os.path.join(st.session_state["current_directory"], "Summary_results_FM.pptx")
-            st.session_state["path2"] = find_maxima_file_path
+        all_slides_content = process_files(st.session_state["data_zipfile"], st.session_state["data_zipfile_hash"], T_and_FM)
+
+        # Stop here if there are no results to make slides with (otherwise the presentations are empty)
+        if not all_slides_content:
+            st.error('No Results.csv files were found in the zip file. It must contain a top-level "Data" folder '
+                     'with one folder per condition (e.g. Data/Condition_1/Quantification/Results.csv).')
+            st.stop()
+        generate_pptxs(all_slides_content, T_and_FM, st.session_state["data_zipfile"].getvalue(), image_dpi)
     
     # Show the download button if there is a Thresholding pptx -this way the button persists across reruns
-    if "path1" in st.session_state:
+    if "pptx_T" in st.session_state:
         with col_2_row_2:
             st.session_state["download1"] = st.download_button(label="Download Threholding file", 
-                               data=open(st.session_state["path1"], "rb").read(), 
+                               data=st.session_state["pptx_T"], 
                                file_name="Summary_results_T.pptx")
 
     # Show the download button if there is a Thresholding pptx -this way the button persists across reruns
-    if "path2" in st.session_state:
+    if "pptx_FM" in st.session_state:
         with col_3_row_2:
             st.session_state["download2"] = st.download_button(label="Download Find Maxima file",  
-                                            data=open(st.session_state["path2"], "rb").read(), 
+                                            data=st.session_state["pptx_FM"], 
                                             file_name="Summary_results_FM.pptx")
 
+    # Show how much smaller the images inserted are, under the button to start (persists across reruns too)
+    if "images_report" in st.session_state:
+        with col_1_row_2:
+            for line in st.session_state["images_report"]:
+                st.caption(line)
+
     return
 
 ###################################################################################################
@@ -680,7 +558,9 @@ def load_third_page():
                 4. <b>Image size:</b> Each image is resized to 3.25cm width by 3cm height. The pairs
                 (yellow + green rectangles) come from the same cell (region of interest). The 
                 fluorescence image is on the left side and the particle mask image is on the right
-                side, with no space separating them horizontally.
+                side, with no space separating them horizontally. Before inserting them, the images are
+                downsampled to the resolution selected (150 DPI by default), which is all the detail that
+                fits in that space, so the presentations are much lighter.
 
                 5. <b>Image labels:</b> There is a 3.25cm width by 1cm height text box right under 
                 each image. The text is normal Times New Roman font, size 20 points. The text of the
@@ -773,11 +653,11 @@ def load_third_page():
 
                 <span style="color: #CCCCCC;">
 
-                1. Unzip the "Data.zip" file to make a "Data" folder, over which we can iterate/walk 
-                through.
+                1. Read the list of files inside the "Data.zip" file (without unzipping it), so all the
+                files are read from memory when they are needed.
                 
-                2. Once the "Data" folder is ready, get all the folders inside as these are the 
-                experimental conditions or groups. Each
+                2. Get all the folders inside the "Data" folder as these are the experimental conditions
+                or groups. Each
                 
                 3. For each Group folder, there must be a Group/Quantification/results.csv file.
 
@@ -790,17 +670,18 @@ def load_third_page():
                 number of them to extract the information of all the images.
 
                 6. Since the csv files already contain almost all the information we need (subtitle, ROI 
-                names, T particle count and FM particle count), we will iterate through the rows of the 
-                csv file instead of walking through the directory of fluorescence images (we could also 
-                extract the info from the path but we would need multiple steps to split different 
-                sections of the path). This strategy also allows us to easily convert the ROI names into 
-                integers so we can sort them properly (natural sorting, the csv file is not in this 
-                order).
+                names, T particle count and FM particle count), we will put the csv files of all the
+                conditions together in one table and use its columns instead of walking through the 
+                directory of fluorescence images (we could also extract the info from the path but we 
+                would need multiple steps to split different sections of the path). The paths of the
+                images are made from the columns of the table, all rows at once. This strategy also 
+                allows us to easily convert the ROI names into integers so we can sort them properly 
+                (natural sorting, the csv file is not in this order).
 
                 </span>
                 <span style="color: #CE9178">
 
-                Up to this step, we will have a huge list containing all the info for all the images
+                Up to this step, we will have a huge table containing all the info for all the images
                 uploaded by the user. The next steps are to group these images to know which ones go 
                 together into the same slide, following a few rules:
                 
@@ -818,19 +699,14 @@ def load_third_page():
                 first 20, make one slide, take the next (up-to) 20 using the same title and subtitle, 
                 make a new slide and so on, until we don't have more images in that subfolder.
 
-                * To accomplish this strategy, we need to iterate through the list generated above 
-                (all_info_for_slides), in which all the information for all the images of all the 
-                conditions is side by side. Because of that, we can iterate through the same level of 
-                the list, take the info of the current item/element, and add its content to a new 
-                temporary variable (list) with 20 spots available. Before adding the info of the current 
-                item/element, we check whether the 20 spots have been filled, check whether the title 
-                has changed, and check whether the subtitle has changed. Any of those 3 cases triggers 
-                the immediate jump to a new slide so we have to pass the info of the grouped images
-                from the temporary variable to a final variable, clear the temporary variable content
-                and then add the current image info to the new slide group. Finally, we repeat this
-                process over and over until we have checked all the items/elements, and the final
-                variable, product of this loop, will contain all the image information grouped by 
-                slide.
+                * To accomplish this strategy, we use the table generated above, in which all the 
+                information for all the images of all the conditions is sorted by condition, subtitle
+                and ROI name. Any change of title or subtitle, or having filled the 20 spots, triggers a
+                new slide. So we group the rows by title and subtitle, number the rows of each group
+                in order (0, 1, 2...), and divide that number by 20 (without decimals) to know which 
+                slide of that subtitle they go to. Each combination of title, subtitle and slide number
+                is a slide, and the final variable (all_slides_content) will contain all the image
+                information grouped by slide.
 
                 * With the final variable we will be able to iterate through each element (slide), call 
                 the function that makes the slides, and pass the current information of the images to
@@ -838,6 +714,8 @@ def load_third_page():
                 of images specified, and finally we save the presentation. We do this twice, once for
                 the images with Thresholding, and once for the images with Find Maxima (info for both
                 sets of images and counts is contained in the same variable all_info_for _slides.
+                Both presentations are made at the same time in separate processes, each one reporting
+                its progress to its own progress bar.
 
                 </span>
 
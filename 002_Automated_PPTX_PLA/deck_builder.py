@@ -0,0 +1,249 @@
+'''
+App made by:
+    Eduardo Reyes Alvarez, Ph.D.
+Contact:
+    eduardo_reyes09@hotmail.com
+
+Module description:
+    Presentation builder for the app 002_Automated_PPTX_PLA. Everything here is plain python-pptx code
+    (no streamlit calls), so each presentation can be made in a separate process and the app only has
+    to show the progress they report.
+
+'''
+###################################################################################################
+
+# Import the required libraries
+
+from io import BytesIO
+from zipfile import ZipFile
+from PIL import Image
+
+# Python-pptx specific modules
+
+# To make the presentation
+from pptx import Presentation
+# To specify sizes of images and text (Other options like inches are available)
+from pptx.util import Cm, Pt            
+# To specify text alignment (the method is used on the text frame, not on the box or the actual text)
+from pptx.enum.text import PP_ALIGN     
+# To work with line and fill colours
+from pptx.enum.dml import MSO_THEME_COLOR
+
+# Size (centimeters) at which the images are shown in the slides, and default resolution used for them
+IMAGE_WIDTH_CM = 3.25
+IMAGE_HEIGHT_CM = 3
+IMAGE_DPI = 150
+
+# Quality of the downsampled images (they are saved as JPEG, like the cropped cells)
+IMAGE_QUALITY = 90
+
+# Number of images downsampled by each task sent to the worker processes
+IMAGES_PER_TASK = 100
+
+###################################################################################################
+
+# Function to reduce an image to the pixels it needs to be shown at the given resolution (DPI)
+# The image is resized to the proportions of the space in the slide, as the presentation would stretch
+# it to that space anyway. Images that are already small enough are kept as they are (never upscaled).
+
+def downsample_image(image_data, dpi=IMAGE_DPI, quality=IMAGE_QUALITY):
+
+    target_width = round(IMAGE_WIDTH_CM / 2.54 * dpi)
+    target_height = round(IMAGE_HEIGHT_CM / 2.54 * dpi)
+
+    with Image.open(BytesIO(image_data)) as image:
+        new_size = (min(image.width, target_width), min(image.height, target_height))
+        if new_size == image.size:
+            return image_data
+        resized_image = image.convert("RGB") if image.mode not in ("RGB", "L") else image
+        resized_image = resized_image.resize(new_size, Image.LANCZOS)
+
+    image_file = BytesIO()
+    resized_image.save(image_file, "JPEG", quality=quality)
+
+    # Keep the original if the new file did not end up smaller
+    return image_file.getvalue() if image_file.tell() < len(image_data) else image_data
+
+###################
+
+# Function to read (once) all the images used in the presentations from the zip file, without decoding them
+# The app sends them in groups to the worker processes to be downsampled, and each presentation then
+# gets the bytes of its own images, so no image is read or resized twice (the fluorescence images are shared)
+
+def read_images(zip_data, image_names):
+
+    with ZipFile(BytesIO(zip_data), 'r') as zip_archive:
+        images = {image_name: zip_archive.read(image_name) for image_name in image_names}
+
+    return images
+
+###################
+
+# Function to downsample a group of images (bytes by name), executed in a worker process
+
+def downsample_images(images, dpi=IMAGE_DPI):
+    return {image_name: downsample_image(image_data, dpi) for image_name, image_data in images.items()}
+
+###################################################################################################
+
+# Function to make one presentation (Thresholding or Find Maxima), executed in a worker process
+# The images are given already read (bytes by name), and the presentation is returned as bytes
+# The progress is sent to the app as (deck, slides done, total slides) through the queue
+
+def build_presentation(template_pptx, images, all_slides_content, images_column, counts_column, 
+                       deck, progress_queue=None):
+
+    # Open the template presentation
+    presentation = Presentation(template_pptx)
+
+    # Iterate through the image info grouped by slide
+    for i,slide_content in enumerate(all_slides_content):
+
+        # Prepare the parameters we need to pass to the function that makes the slides
+        current_slide_title = slide_content[0][0]
+        current_slide_subtitle = slide_content[0][1]
+        image_count_for_slide = len(slide_content)
+        F_images_for_slide = [image[2] for image in slide_content]
+        F_images_labels = [image[3] for image in slide_content]
+        P_images_for_slide = [image[images_column] for image in slide_content]
+        P_images_labels = [image[counts_column] for image in slide_content]
+
+        # Feed the function that makes the slide and inserts the corresponding images
+        presentation = slide_maker(presentation, current_slide_title, current_slide_subtitle, image_count_for_slide, 
+                                   F_images_for_slide, P_images_for_slide, F_images_labels, P_images_labels, images)
+
+        # Report the progress
+        if progress_queue is not None:
+            progress_queue.put((deck, i+1, len(all_slides_content)))
+
+    # Finally, save this summary presentation after all slides have been created
+    pptx_file = BytesIO()
+    presentation.save(pptx_file)
+
+    return pptx_file.getvalue()
+
+###################################################################################################
+
+# Function to add slides to a pptx and inserts images+text 
+
+def slide_maker(presentation_input, current_slide_title, current_slide_subtitle, image_count_for_slide, 
+                F_images_for_slide, P_images_for_slide, F_images_labels, P_images_labels, images):
+
+    # All coordinates are stated always in the same order: From left first, from top second.
+
+    # Title text box dimensions and coordinates (centimeters) 
+    title_width = 17
+    title_height = 1.5
+    title_left_coordinate = 0
+    title_top_coordinate = 0
+    
+    # Subtitle text box dimensions and coordinates (centimeters)
+    subtitle_width = 17
+    subtitle_height = 1.5
+    subtitle_left_coordinate = 17
+    subtitle_top_coordinate = 0
+    
+    # Size and coordinates for the 20 pairs of images (centimeters)
+    image_width = IMAGE_WIDTH_CM
+    image_height = IMAGE_HEIGHT_CM
+    image_coordinates = [
+    (0.25, 2.1, 3.5, 2.1),   (7, 2.1, 10.25, 2.1),   (13.75 , 2.1, 17, 2.1),  (20.5, 2.1, 23.75, 2.1),    (27.25, 2.1, 30.5, 2.1),
+    (0.25, 6.4, 3.5, 6.4),   (7, 6.4, 10.25, 6.4),   (13.75, 6.4, 17, 6.4),   (20.5, 6.4, 23.75, 6.4),    (27.25, 6.4, 30.5, 6.4),
+    (0.25, 10.7, 3.5, 10.7), (7, 10.7, 10.25, 10.7), (13.75, 10.7, 17, 10.7), (20.5, 10.7, 23.75, 10.7),  (27.25, 10.7, 30.5, 10.7),
+    (0.25, 15, 3.5, 15),     (7, 15, 10.25, 15),     (13.75, 15, 17, 15),     (20.5, 15, 23.75, 15),      (27.25, 15, 30.5, 15)
+    ]
+    
+    # Size and coordinates for the 20 pairs of text labels (centimeters) (+3cm top coordinate of images)
+    image_labels_width = 3.25
+    image_labels_height = 1
+    image_labels_coordinates = [
+    (0.25, 5.1, 3.5, 5.1),   (7, 5.1, 10.25, 5.1),   (13.75 , 5.1, 17, 5.1),  (20.5, 5.1, 23.75, 5.1),    (27.25, 5.1, 30.5, 5.1),
+    (0.25, 9.4, 3.5, 9.4),   (7, 9.4, 10.25, 9.4),   (13.75, 9.4, 17, 9.4),   (20.5, 9.4, 23.75, 9.4),    (27.25, 9.4, 30.5, 9.4),
+    (0.25, 13.7, 3.5, 13.7), (7, 13.7, 10.25, 13.7), (13.75, 13.7, 17, 13.7), (20.5, 13.7, 23.75, 13.7),  (27.25, 13.7, 30.5, 13.7),
+    (0.25, 18, 3.5, 18),     (7, 18, 10.25, 18),     (13.75, 18, 17, 18),     (20.5, 18, 23.75, 18),      (27.25, 18, 30.5, 18)
+    ]
+    
+    # Create a new slide (layout Blank)
+    blank_slide_layout = presentation_input.slide_layouts[6]
+    slide = presentation_input.slides.add_slide(blank_slide_layout)
+    
+    # Make the title for this experimental condition
+    left = Cm(title_left_coordinate)
+    top = Cm(title_top_coordinate)
+    width = Cm(title_width)
+    height = Cm(title_height)
+    title_textbox = slide.shapes.add_textbox(left, top, width, height)
+    title_frame = title_textbox.text_frame
+    title_text = title_frame.paragraphs[0]
+    title_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
+    title_text.text = current_slide_title
+    title_text.font.bold = True
+    title_text.font.size = Pt(32)
+    title_text.font.name = "Times New Roman"
+    
+    # Make the subtitle for the image where the ROI was cropped from
+    left = Cm(subtitle_left_coordinate)
+    top = Cm(subtitle_top_coordinate)
+    width = Cm(subtitle_width)
+    height = Cm(subtitle_height)
+    subtitle_textbox = slide.shapes.add_textbox(left, top, width, height)
+    subtitle_frame = subtitle_textbox.text_frame
+    subtitle_text = subtitle_frame.paragraphs[0]
+    subtitle_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
+    subtitle_text.text = current_slide_subtitle
+    subtitle_text.font.size = Pt(32)
+    subtitle_text.font.name = "Times New Roman"
+    
+    # Based on the number of images for the current slide, retrieve the neccesary images and coordinates
+    for i in range(image_count_for_slide):
+        
+        # Find the images to insert (already read and downsampled, as in-memory streams)
+        fluorescence_image = BytesIO(images[F_images_for_slide[i]])
+        particle_image = BytesIO(images[P_images_for_slide[i]])
+        
+        # Insert the cropped cell from the Fluorescence folder first
+        left = Cm(image_coordinates[i][0])
+        top = Cm(image_coordinates[i][1])
+        width = Cm(image_width)
+        height = Cm(image_height)
+        inserting_image = slide.shapes.add_picture(fluorescence_image, left, top, width, height)
+        
+        # Insert the text label corresponding to the image just inserted above
+        left = Cm(image_labels_coordinates[i][0])
+        top = Cm(image_labels_coordinates[i][1])
+        width = Cm(image_labels_width)
+        height = Cm(image_labels_height)
+        inserting_image_textbox = slide.shapes.add_textbox(left, top, width, height)
+        inserting_image_frame = inserting_image_textbox.text_frame
+        inserting_image_text = inserting_image_frame.paragraphs[0]
+        inserting_image_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
+        inserting_image_text.text = F_images_labels[i]
+        inserting_image_text.font.size = Pt(20)
+        inserting_image_text.font.name = "Times New Roman"
+        
+        # Insert the cropped cell from the Particles folder second (FM or T particles)
+        left = Cm(image_coordinates[i][2])
+        top = Cm(image_coordinates[i][3])
+        width = Cm(image_width)
+        height = Cm(image_height)
+        inserting_image2 = slide.shapes.add_picture(particle_image, left, top, width, height)
+        inserting_image2.line.fill.solid()
+        inserting_image2.line.width = Pt(0.5)
+        inserting_image2.line.fill.fore_color.theme_color = MSO_THEME_COLOR.ACCENT_1
+    
+        # Insert the text label corresponding to the particle counts just inserted above
+        left = Cm(image_labels_coordinates[i][2])
+        top = Cm(image_labels_coordinates[i][3])
+        width = Cm(image_labels_width)
+        height = Cm(image_labels_height)
+        inserting_image2_textbox = slide.shapes.add_textbox(left, top, width, height)
+        inserting_image2_frame = inserting_image2_textbox.text_frame
+        inserting_image2_text = inserting_image2_frame.paragraphs[0]
+        inserting_image2_frame.paragraphs[0].alignment = PP_ALIGN.CENTER
+        inserting_image2_text.text = "P="+str(P_images_labels[i])
+        inserting_image2_text.font.size = Pt(20)
+        inserting_image2_text.font.name = "Times New Roman"
+    
+    return presentation_input
+
+###################################################################################################